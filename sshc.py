@@ -1,37 +1,114 @@
 #!/usr/bin/python
 
+import base64
 import curses
+import errno
+import gzip
+import hashlib
+import ipaddress
+import json
 import os
 import re
+import select
+import selectors
 import signal
 import socket
+import stat
 import subprocess
+import tempfile
 import threading
 import traceback
 import warnings
 import shutil
 import sys
-from copy import deepcopy
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from getpass import getpass, getuser
+from itertools import count, islice
 from curses.textpad import Textbox
-from time import sleep, time
+from time import perf_counter, sleep, time
+from types import MappingProxyType
 from secrets import token_urlsafe
 
 
-alt_pressed = focused = nodetails = tab_completion = False
+alt_pressed = focused = nodetails = tab_completion = search_ready = search_stale = False
 nested = highlstr = topprof = topconn = pos = conn_count = debug = 0
-copied_details = sort = file_selection = unprompted_file = ''
+copied_details = sort = search = file_selection = unprompted_file = pipes_dir = ''
 tunnels = {}
-undo_changes = {'outer': []}
-redo_changes = {'outer': []}
-buffer_changes = {'outer': []}
+undo_log = {}       # scope ('outer' or a profile id) -> deque of (sequence number, inverse operations) for every change
+redo_log = {}
+change_ops = []     # inverse operations recorded by the helpers since the last keypress
+history_seq = count()
+history_lines = 0
 msgq = []
+control_refused = False     # an unsafe control_dir is reported only once
 upload_to_history = []
 upload_from_history = []
 picked_cons = set()
+frame = {}
+prof_heads = []     # offsets of the profile headers inside the profiles list
+shown_profs = []    # ordinals (positions in prof_heads) of the profiles matching the sort pattern
+sort_stack = []     # (sort string, shown_profs) for each narrowing step, so that typing only rechecks the previous matches
+prof_ids = []       # stable ids of the profiles, parallel to prof_heads
+prof_id = count()
+id_nums = {}        # profile id -> ordinal, rebuilt lazily after profiles were added or removed
+search_grams = {}   # trigram -> ids of the profiles having it in any of their records
+prof_grams = {}     # profile id -> Counter of the records containing each trigram
 pattern = re.compile(rf'^{sort}.*|.*\| *{sort}.*', re.I)
+parsed_conns = {}   # (profile line, host line) -> (params, commands) as returned by parse_conn()
+dir_cache = {}      # directory path -> (mtime, sorted names, names of the subdirectories) for the path autocompletion
+param_res = {param: (re.compile(rf'{param} ([^ ]+)'), re.compile(rf'{param} [^ ]+ ?')) for param in ['port', 'pass', 'user']}
+creds_re = re.compile(r'^([^ ]+)/([^ ]+)')
+key_creds_re = re.compile(r'key ([^ ]+)/([^ ]+)')
+key_user_re = re.compile(r'^key [^ /]+')
+key_name_re = re.compile(r'key (\w+)')
+placeholder_re = re.compile(r'\{(\w+)\}')
+wf_re = re.compile(r"wf (\d+)? ?'(.*)' then '(.*)'")
+address_re = re.compile(r'[0-9A-Za-z:][0-9A-Za-z:.\-/%]*[0-9A-Za-z:]')     # compressed IPv6 may start or end with ::
+# names of files (backup.tar.gz, dump.sql) look the same as host names, so the usual extensions are not taken for a TLD
+fqdn_re = re.compile(r'(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+(?!(?:gz|tgz|bz2|xz|zst|zip|rar|7z|tar|sql|db|txt|log|out|err|'
+                     r'csv|json|yml|yaml|xml|html?|md|rst|conf|cfg|ini|bak|old|orig|tmp|swp|pid|lock|sock|pem|key|crt|'
+                     r'pdf|docx?|xlsx?|jpe?g|png|gif|js|rb|php|exe|dll|so|iso|img|deb|rpm)\Z)[a-z]{2,}', re.I)
+jump_re = re.compile(r'(?:-J +|ProxyJump[= ]+)([^ ,]+)')
+sensitive_res = [(re.compile(r"(wf \d* ?'.*?' then )'.*?'"), r"\g<1>'******'"),
+                 (re.compile(r"(pass )[^ ]*"), r"\g<1>******"),
+                 (re.compile(r'^!?([^ ]+/)[^ ]+'), r"\g<1>******")]
 stop_print = threading.Event()
 lock = threading.Lock()
+tmux_pending = deque()      # (command, future) for every command sent to tmux and not yet answered
+conn_queue = []             # [pane, profile id, host line, attempt, profile key, jump key] of the connections waiting for a worker
+conn_active = {}            # profile or jump key -> the number of connections being set up through it
+conn_workers = []
+conn_cond = threading.Condition()
+next_conn_start = 0
+children = {}               # pid -> fd, pidfd, password to send, tunnel id, transfer and the tail of the output of every forked process
+child_queue = deque()       # (cmd, args, password, tunnel id, transfer) of the processes waiting for a free slot
+transfers = {}              # transfer id -> [description, number of hosts, finished, failed hosts] of the file transfers in progress
+transfer_id = count()
+children_lock = threading.Lock()
+probes = {}                 # tunnel id -> (socket, start time) of the health checks in flight
+tunnel_id = count()
+tunnel_lock = threading.Lock()      # restarts come both from the supervisor and from the main loop
+log = None
+log_queue = deque()         # lines passed to wrt() and not yet written by the log writer
+log_cond = threading.Condition()
+log_writer = None
+log_viewer = None           # the thread tailing the log under the highlighted record, if it is shown
+templ_pending = set()       # #{...} commands of the templates which are still being executed
+templ_cond = threading.Condition()
+journal_path = None         # set once the profiles file is known to be either plain or encrypted
+journal_queue = deque()     # records and snapshots waiting for the journal writer
+journal_cond = threading.Condition()
+journal_writer = None
+journal_count = 0           # records written since the last compaction
+journal_compacted = False
+generation = saved_generation = 0
+prof_gens = {}              # profile id -> generation of its last change
+selector = selectors.DefaultSelector()
+supervisor = None
+supervisor_wakeup = os.pipe()
+selector.register(supervisor_wakeup[0], selectors.EVENT_READ)
 tabsize = curses.get_tabsize()
 
 # os.forkpty() complains about multi-threaded enviroment, but as far as i've read, deadlocks might appear only
@@ -61,38 +138,57 @@ def accept_input(message='', preinput='', start=None, voffset=0):
     focused = False
     return res
 
+# Directory listings are cached until the mtime of the directory changes, the entry types come from scandir without extra stats
+def list_dir(path):
+    try:
+        mtime = os.stat(path).st_mtime_ns
+        if path in dir_cache and dir_cache[path][0] == mtime:
+            return dir_cache[path]
+        names, dirs = [], set()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                names.append(entry.name)
+                try:
+                    if entry.is_dir():
+                        dirs.add(entry.name)
+                except OSError:
+                    pass
+    except OSError:
+        return None
+    names.sort()
+    if len(dir_cache) > 1000:
+        dir_cache.clear()
+    dir_cache[path] = (mtime, names, dirs)
+    return dir_cache[path]
+
 def autocomplete(path):
-    def addslash(s):
-        if os.path.isdir(path[:path.rfind('/') + 1] + s) and not s.endswith('/'):
-            return s + '/'
-        return s
-
-    if not path:
-        path = '/'
-    file = path[path.rfind('/') + 1:]
-    path = path[:path.rfind('/') + 1]
-    if not os.access(path, os.R_OK):
-        return path, ['can not access the directory']
-
-    suggestions = [f for f in os.listdir(path) if re.match(rf'{re.escape(file)}.*', f) and not f.startswith('.')]
-    if file.startswith('.'):
-        suggestions = [f for f in os.listdir(path) if re.match(rf'{re.escape(file)}.*', f) and f.startswith('.')]
-    if len(suggestions) > 1:
-        for pos, char in enumerate(sorted(suggestions, key=len)[0], 0):
-            if len(suggestions) == len([sug for sug in suggestions if sug[pos] == char]):
-                path += char
-                continue
-            break
-    elif len(suggestions) == 1:
-        if not os.path.isdir(path + suggestions[0]):
-            return path + suggestions[0], []
-        path, suggestions = autocomplete(path + suggestions[0] + '/')
-    else:
-        if len(os.listdir(path)) == 0:
+    while True:
+        if not path:
+            path = '/'
+        file = path[path.rfind('/') + 1:]
+        path = path[:path.rfind('/') + 1]
+        listing = list_dir(path)
+        if listing is None:
+            return path, ['can not access the directory']
+        _, names, dirs = listing
+
+        # Names sharing the prefix are adjacent in the sorted listing
+        suggestions = names[bisect_left(names, file):bisect_left(names, file + '\U0010ffff')]
+        if not file:
+            suggestions = [f for f in suggestions if not f.startswith('.')]
+        if len(suggestions) > 1:
+            path += os.path.commonprefix([suggestions[0], suggestions[-1]])
+            return path, [f + '/' if f in dirs else f for f in suggestions]
+        if len(suggestions) == 1:
+            if suggestions[0] not in dirs:
+                return path + suggestions[0], []
+            path += suggestions[0] + '/'
+        elif not names:
             return path, ['directory is empty']
-        path, suggestions = autocomplete(path + file[:-1])
-
-    return path, list(map(addslash, suggestions))
+        elif not file:
+            return path, []
+        else:
+            path += file[:-1]
 
 def autocomplete_loop(msg, path):
     global tab_completion
@@ -112,13 +208,23 @@ def autocomplete_loop(msg, path):
 
 def conn_params(conn_num=None, prof_index=None, commands=False):
     if prof_index is None:
-        prof_index = profiles.index([i for i in profiles if i[0] != '\t' and pattern.match(i)][topprof:][highlstr])
+        prof_index = resolve('prof')
         conn_index = prof_index + pos
     if conn_num is not None:
         conn_index = prof_index + conn_num
 
-    conn_str = profiles[conn_index].strip().split('\t')
-    prof_str = profiles[prof_index].strip().split('\t')
+    key = (profiles[prof_index], profiles[conn_index])
+    parsed = parsed_conns.get(key)   # a local, the cache can be cleared by substitute_templ() in the meantime
+    if parsed is None:
+        if len(parsed_conns) > 10000:
+            parsed_conns.clear()
+        parsed = parsed_conns[key] = parse_conn(*key)
+    return parsed[1 if commands else 0]
+
+# Parsed once per a pair of profile and host lines, the result is cached in parsed_conns until one of them is changed
+def parse_conn(prof_line, conn_line):
+    conn_str = conn_line.strip().split('\t')
+    prof_str = prof_line.strip().split('\t')
     params = \
     {
         'prof_name': prof_str[0],
@@ -150,33 +256,31 @@ def conn_params(conn_num=None, prof_index=None, commands=False):
         for templ in cfg['templ_list']:
             if pstr.startswith(templ + ' ') or pstr == templ:
                 params['syntax'] = templ
-        for param in ['port', 'pass', 'user']:
+        for param, (param_re, param_strip) in param_res.items():
             if param + ' ' in pstr:
-                params[param] = re.search(rf'{param} ([^ ]+)', pstr).group(1)
-                pstr = re.sub(rf'{param} [^ ]+ ?', '', pstr)
+                params[param] = param_re.search(pstr).group(1)
+                pstr = param_strip.sub('', pstr)
 
-        if re.match(r'^[^ ]+/[^ ]', pstr):
-            params['user'], params['pass'] = re.search(r'^([^ ]+)/([^ ]+)', pstr).groups()
-        
-        if re.match('key [^ ]+/[^ ]', pstr):
-            params['user'], params['key'] = re.search(r'key ([^ ]+)?/([^ ]+)', pstr).groups()
-        
-        elif re.match('^key [^ /]+', pstr):
-            params['user'] = re.search(r'key (\w+)', pstr).group(1)
+        if found := creds_re.match(pstr):
+            params['user'], params['pass'] = found.groups()
+
+        if found := key_creds_re.match(pstr):
+            params['user'], params['key'] = found.groups()
+
+        elif key_user_re.match(pstr):
+            params['user'] = key_name_re.search(pstr).group(1)
             params['key'] = cfg['key']
 
     if params['key']:
         params['key']= cfg['keys_path'] + params['key']
-            
-
-    if not commands:
-        return params
+    params['control'] = control_path(params) if int(cfg['control_master']) and params['syntax'] is None else None
 
     command = 'ssh {user}@{address} -p {port}' if params['syntax'] is None else cfg['templ_list'][params['syntax']]
     if params['key'] is not None:
         command += f' -i {params["key"]}'
-    for param, value in params.items():
-        command = command.replace('{'+param+'}', str(value))
+    if params['control'] is not None:
+        command += f" -o ControlMaster=auto -o ControlPath={params['control']} -o ControlPersist={cfg['control_persist']}"
+    command = placeholder_re.sub(lambda found: str(params[found.group(1)]) if found.group(1) in params else found.group(0), command)
     command = command.split(', ')
 
     if params['pass'] is not None:
@@ -184,38 +288,201 @@ def conn_params(conn_num=None, prof_index=None, commands=False):
     for i in params['afterwards'].split(', '):
         if len(i) > 0:
             command.append(i.strip())
-    return command
+    return MappingProxyType(params), tuple(command)
 
 
+# Hosts are multiplexed through a master connection per (user, address, port, key), the first pane connecting to a host
+# becomes its master and ControlPersist keeps it in the background until it has been idle for control_persist seconds
+def control_path(params):
+    if not control_dir_safe():
+        return None
+    digest = hashlib.sha1(repr((params['user'], params['address'], params['port'], params['key'])).encode()).hexdigest()
+    return f"{cfg['control_dir']}/{digest[:16]}"
+
+# Anyone able to write into control_dir could put their own sockets in place of the masters, so the directory
+# is only used if it is a real directory owned by the user and closed to everyone else
+def control_dir_safe():
+    global control_refused
+    try:
+        os.mkdir(cfg['control_dir'], 0o700)
+    except OSError:
+        pass
+    try:
+        st = os.lstat(cfg['control_dir'])
+        safe = stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and stat.S_IMODE(st.st_mode) == 0o700
+    except OSError:
+        safe = False
+    if not safe and not control_refused:
+        control_refused = True
+        msgq.append(f"{cfg['control_dir']} is not a directory owned by you with 0700 permissions, master connections are disabled")
+    return safe
+
+# A master is alive if its socket accepts a connection, which is instant, unlike asking it with ssh -O check
+def master_alive(control):
+    if control is None:
+        return False
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.settimeout(0.5)
+        try:
+            sock.connect(control)
+        except OSError:
+            return False
+    return True
+
+# Output of the pane is streamed through pipe-pane into a fifo, so a 'wait for' step reacts as soon as the expected
+# string is printed, while all of the commands between the waits are sent to tmux as a single batch
 def create_connection(pane, conn_num, prof_index=None, name=''):
-    line = 0
-    for command in conn_params(conn_num, prof_index, commands=True):
+    global pipes_dir
+    params = conn_params(conn_num, prof_index)
+    if params['syntax'] is not None and not wait_templ(params['syntax']):
+        wrt(f'Template {params["syntax"]} is still not substituted, its commands are sent as they are')
+    commands = conn_params(conn_num, prof_index, commands=True)
+    if params['pass'] is not None and master_alive(params['control']):
+        # the master is already authenticated, so there will be no password prompt to wait for
+        commands = tuple(command for command in commands if command != f"wf '' then '{params['pass']}'")
+    if not any(command.startswith('wf') for command in commands):
+        send_keys(pane, commands)
+        return True
+
+    if not pipes_dir:
+        pipes_dir = tempfile.mkdtemp(prefix='sshc-')
+    fifo = f'{pipes_dir}/{pane.lstrip("%")}'
+    os.mkfifo(fifo)
+    fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+    tmux_exec(f"pipe-pane -t {pane} 'cat > {fifo}'")
+    try:
+        batch = []
+        for command in commands:
+            if not command.startswith('wf'):
+                batch.append(command)
+                continue
 
-        if command.startswith('wf'):
-            sent = False
             try:
-                timeout, waitfor, send = re.search(r"wf (\d+)? ?'(.*)' then '(.*)'", command).groups()
+                timeout, waitfor, send = wf_re.search(command).groups()
                 if not waitfor:
                     waitfor = cfg['wf_default']
             except Exception:
                 raise AssertionError("Could not parse 'wait for' expression, further execution terminated")
 
-            if timeout is None:
-                timeout = cfg['wf_timeout']
-            start = time()
-            while time() - start < timeout:
-                content = tmux_exec(f'capture-pane -t {pane} -p -S {line} -E {line + cfg["wf_lines"] - 1}', output=cfg['wf_lines'])
-                if content:
-                    if sent: break
-                    line += content.count('\n')
-                    if waitfor in content:
-                        tmux_exec(f"send-keys -t {pane} '{send}' Enter")
-                        sent = True
-                sleep(0.1)
+            send_keys(pane, batch)
+            batch = []
+            deadline = time() + int(timeout if timeout is not None else cfg['wf_timeout'])
+            if not wait_output(fd, waitfor, deadline):
+                return False        # If timeout occured, do not send the rest
+            tmux_exec(f"send-keys -t {pane} '{send}' Enter")
+            if not wait_output(fd, '', deadline):
+                return False
+        send_keys(pane, batch)
+        return True
+    finally:
+        tmux_exec(f'pipe-pane -t {pane}')
+        os.close(fd)
+        os.remove(fifo)
+
+def send_keys(pane, commands):
+    if commands:
+        tmux_submit('\n'.join(f"send-keys -t {pane} '{command.rstrip('!')}' " + ('' if command.endswith('!') else 'Enter') for command in commands))
+
+def wait_output(fd, waitfor, deadline):
+    output = ''
+    while deadline > time():
+        if not select.select([fd], [], [], deadline - time())[0]:
+            return False
+        chunk = os.read(fd, 4096)
+        if not chunk:       # pipe-pane was stopped or the pane was closed
+            return False
+        output = (output + chunk.decode(errors='replace'))[-(len(waitfor) + 4096):]
+        if waitfor in output:
+            return True
+    return False
+
+
+# Connections are set up by a fixed number of workers, which take the first queued connection whose profile and jump host
+# are below their limits, so a few hundred hosts behind one bastion do not log in all at once
+# A job keeps the profile id and the host line rather than their positions, which change as soon as a profile
+# is added above, removed or sorted, while the job waits in the queue or for its retry
+def schedule_connection(pane, conn_num, prof_index, attempt=0):
+    queue_connection(pane, prof_ids[prof_num(prof_index)], profiles[prof_index + conn_num], attempt)
+
+def queue_connection(pane, pid, host, attempt):
+    located = locate_host(pid, host)
+    if located is None:
+        wrt(f'The host of the connection in {pane} was removed or changed, the connection is dropped')
+        return
+    params = conn_params(*located)
+    jump = jump_re.search(conn_params(*located, commands=True)[0])
+    job = [pane, pid, host, attempt, ('profile', params['prof_name']), ('jump', jump.group(1) if jump else params['address'])]
+    with conn_cond:
+        conn_queue.append(job)
+        while len(conn_workers) < int(cfg['max_connecting']):
+            conn_workers.append(threading.Thread(target=__connection_worker, daemon=True))
+            conn_workers[-1].start()
+        conn_cond.notify()
+
+def locate_host(pid, host):
+    try:
+        num = prof_ids.index(pid)     # id_nums is rebuilt by the UI thread, the workers do not rely on it
+    except ValueError:
+        return None
+    lines = profiles[prof_heads[num]:prof_end(num)]
+    if host not in lines:
+        return None
+    return lines.index(host), prof_heads[num]
+
+def connection_slot_free(job):
+    limits = {'profile': int(cfg['max_per_profile']), 'jump': int(cfg['max_per_jump'])}
+    return all(not limits[key[0]] or conn_active.get(key, 0) < limits[key[0]] for key in job[4:])
+
+def __connection_worker():
+    global next_conn_start
+    while True:
+        with conn_cond:
+            while not (job := next((job for job in conn_queue if connection_slot_free(job)), None)):
+                conn_cond.wait()
+            conn_queue.remove(job)
+            for key in job[4:]:
+                conn_active[key] = conn_active.get(key, 0) + 1
+            delay = 0
+            if int(cfg['conn_rate']):
+                delay = max(0, next_conn_start - time())
+                next_conn_start = time() + delay + 1 / int(cfg['conn_rate'])
+
+        pane, pid, host, attempt = job[:4]
+        sleep(delay)
+        try:
+            located = locate_host(pid, host)
+            if located is None:
+                wrt(f'The host of the connection in {pane} was removed or changed, the connection is dropped')
+                done = True
             else:
-                break       # If timeout occured, do not send the rest
+                done = create_connection(pane, *located)
+        except Exception:
+            wrt(traceback.format_exc())
+            done = True     # nothing to retry, the error was in the connection details
+        finally:
+            with conn_cond:
+                for key in job[4:]:
+                    conn_active[key] -= 1
+                conn_cond.notify_all()
+
+        if done:
+            continue
+        if attempt < int(cfg['wf_retries']):
+            wrt(f'Waiting for the prompt in {pane} timed out, retrying in {2 ** attempt} seconds')
+            tmux_exec(f'send-keys -t {pane} C-c')
+            retry = threading.Timer(2 ** attempt, queue_connection, args=[pane, pid, host, attempt + 1])
+            retry.daemon = True     # a pending retry must not hold the exit
+            retry.start()
         else:
-            tmux_exec(f"send-keys -t {pane} '{command.rstrip('!')}' " + ('' if command.endswith('!') else 'Enter'))
+            msgq.append(f'Connection in {pane} did not get the expected prompt after {attempt + 1} attempts')
+
+def connection_queue_hint():
+    with conn_cond:         # the workers change conn_active all the time
+        active = sum(count for key, count in conn_active.items() if key[0] == 'profile')
+        queued = len(conn_queue)
+    if not active and not queued:
+        return ''
+    return f'   Connecting: {active} active, {queued} queued'
 
 
 def decrypt(file, passphrase=None):
@@ -228,8 +495,82 @@ def decrypt(file, passphrase=None):
     except OSError:
         exit(f'{file} file can not be opened')
 
+def init_keyring():
+    global KEYRING, keyring
+    if KEYRING is not None:
+        return KEYRING
+    KEYRING = 0
+    try:
+        import keyring
+        ringname = keyring.get_keyring().name
+        if ringname == 'fail Keyring':
+            msgq.append(f'keyring module is installed, but no suitable backend found')
+        else:
+            KEYRING = 1
+        msgq.append(f'Initializied keyring using the following backend - {ringname}')
+    except ModuleNotFoundError:
+        msgq.append('keyring module is not installed')
+    except keyring.errors.InitError:
+        msgq.append('keyring module is installed, but failed to initialize')
+    mark_startup('keyring')
+    return KEYRING
+
+def init_gnupg():
+    global GNUPG, gpg
+    if GNUPG is not None:
+        return GNUPG
+    GNUPG = 0
+    try:
+        from gnupg import GPG
+        if shutil.which('gpg'):
+            gpg = GPG()
+            GNUPG = 1
+        else:
+            msgq.append('gnupg module is installed, but no gpg executable found')
+    except ModuleNotFoundError:
+        msgq.append('gnupg module is not installed niether globally nor in a virtual environment')
+    mark_startup('gnupg')
+    return GNUPG
+
+# Tells an OpenPGP message from a text file by its first bytes, named the same way as 'file --mime-type' does
+def file_type(path):
+    with open(path, 'rb') as f:
+        head = f.read(65536)
+    if not head:
+        return 'empty'
+    if head.startswith(b'-----BEGIN PGP MESSAGE-----'):
+        return 'pgp-encrypted'
+    if head[0] & 0x80 and len(head) > 6:      # a packet header, either in the new (0x40 set) or the old format
+        if head[0] & 0x40:
+            tag = head[0] & 0x3f
+            lenlen = 1 if head[1] < 192 or 224 <= head[1] < 255 else 2 if head[1] < 224 else 5
+        else:
+            tag = (head[0] >> 2) & 0x0f
+            lenlen = (1, 2, 4, 0)[head[0] & 0x03]
+        version = head[1 + lenlen]
+        # session keys and encrypted data packets, each starting with a version number
+        if (tag, version) in ((1, 3), (3, 4), (3, 5), (3, 6), (18, 1), (18, 2), (20, 1)):
+            return 'pgp-encrypted'
+    try:
+        head.decode()
+    except UnicodeDecodeError as exc:
+        if exc.start < len(head) - 4:       # not just a multibyte character cut by the read size
+            return 'data'
+    return 'data' if b'\0' in head else 'plain'
+
+def mark_startup(phase):
+    if startup_marks is not None:
+        startup_marks.append((phase, perf_counter()))
+
+def startup_report():
+    report = [f'{phase} - {(end - start) * 1000:.1f} ms' for (_, start), (phase, end) in zip(startup_marks, startup_marks[1:])]
+    return f'Startup took {(startup_marks[-1][1] - startup_marks[0][1]) * 1000:.1f} ms:\n' + '\n'.join(report)
+
 def deinitialize_scr(noexit=False):
+    flush_log()
     os.remove(cfg['pidfile_path'] + '/pid')
+    if pipes_dir:
+        shutil.rmtree(pipes_dir, ignore_errors=True)
     scr.keypad(0)
     curses.echo()
     curses.nocbreak()
@@ -241,6 +582,7 @@ def deinitialize_scr(noexit=False):
 def handle_resize():
     global focused, max_displayed
     curses.update_lines_cols()
+    frame.clear()
     max_displayed = int(cfg['max_conn_displayed']) if curses.LINES - 3 > int(cfg['max_conn_displayed']) else curses.LINES - 3
     if focused:
         focused = False
@@ -249,11 +591,557 @@ def handle_resize():
         redraw()
 
 def hide_sensitive(params):
-    params = re.sub(r"(wf \d* ?'.*?' then )'.*?'", r"\g<1>'******'", params)
-    params = re.sub(r"(pass )[^ ]*", r"\g<1>******", params)
-    params = re.sub(r'^!?([^ ]+/)[^ ]+', r"\g<1>******", params)
+    for sensitive, masked in sensitive_res:
+        params = sensitive.sub(masked, params)
     return params
 
+# The index is kept alongside the flat profiles list, so that the cursor movement does not rescan the whole list.
+# All of the changes to the profiles list have to be made through insert_lines(), remove_lines() and set_line()
+def index_profiles(ids=None):
+    global prof_heads, prof_ids, search_ready
+    prof_heads = [i for i, line in enumerate(profiles) if line[0] != '\t']
+    if ids is None:
+        prof_ids = [next(prof_id) for _ in prof_heads]
+        search_grams.clear()
+        prof_grams.clear()
+        search_ready = False
+        clear_history()
+    else:
+        prof_ids = ids
+    id_nums.clear()
+    sort_stack.clear()
+    filter_profiles()
+    bump(*range(len(prof_heads)) if ids is None else ())
+
+# Every change of profiles increments the generation, profiles touched by it remember the generation in prof_gens,
+# so anything derived from them only has to compare numbers to know whether it is stale
+def bump(*nums):
+    global generation
+    generation += 1
+    for num in nums:
+        prof_gens[prof_ids[num]] = generation
+
+def changed_profiles(since):
+    return [pid for pid in prof_ids if prof_gens.get(pid, 0) > since]
+
+# A longer sort string can only match a subset of what the shorter one did, so only the previous matches are rechecked,
+# while removing characters just drops the narrowing steps. Any change of the headers invalidates the stack
+def filter_profiles():
+    global shown_profs, search_stale
+    if search:
+        shown_profs = search_profiles(search)
+        search_stale = False
+        return
+    key = sort.lower()
+    while sort_stack and not key.startswith(sort_stack[-1][0]):
+        sort_stack.pop()
+    if sort_stack and sort_stack[-1][0] == key:
+        shown_profs = sort_stack[-1][1]
+        return
+    candidates = sort_stack[-1][1] if sort_stack else range(len(prof_heads))
+    shown_profs = [num for num in candidates if pattern.match(profiles[prof_heads[num]])]
+    sort_stack.append((key, shown_profs))
+
+def insert_lines(index, lines, ids=None):
+    global shown_profs, search_stale
+    journal('i', index, list(lines))
+    heads = [index + i for i, line in enumerate(lines) if line[0] != '\t']
+    hosts = heads[0] - index if heads else len(lines)       # leading hosts are added to the profile above
+    if hosts:
+        owner = prof_num(index - 1)
+        record('r', prof_ids[owner], index - prof_heads[owner], hosts)
+    profiles[index:index] = lines
+    at = bisect_left(prof_heads, index)
+    prof_heads[at:] = heads + [head + len(lines) for head in prof_heads[at:]]
+    if heads:
+        prof_ids[at:at] = ids or [next(prof_id) for _ in heads]
+        record('rp', prof_ids[at:at + len(heads)])
+        id_nums.clear()
+        sort_stack.clear()
+        shown_profs = [num if num < at else num + len(heads) for num in shown_profs]
+        for num in range(at, at + len(heads)):
+            if not search and pattern.match(profiles[prof_heads[num]]):
+                insort(shown_profs, num)
+    for i in range(index, index + len(lines)):
+        index_grams(i, 1)
+    bump(*{prof_num(i) for i in range(index, index + len(lines))})
+    search_stale = bool(search)
+
+def remove_lines(index, count=1):
+    global shown_profs, search_stale
+    journal('r', index, count)
+    owner = prof_num(index) if profiles[index][0] == '\t' else None     # the profile losing its hosts
+    start = bisect_left(prof_heads, index)
+    end = bisect_left(prof_heads, index + count)
+    if owner is not None:
+        record('i', prof_ids[owner], index - prof_heads[owner], profiles[index:min(index + count, prof_end(owner))])
+    if end > start:
+        record('ip', [(prof_ids[num], profiles[prof_heads[num]:prof_end(num)]) for num in range(start, end)],
+               prof_ids[end] if end < len(prof_ids) else None)
+    for i in range(index, index + count):
+        index_grams(i, -1)
+        forget_parsed(i)
+    del profiles[index:index + count]
+    prof_heads[start:] = [head - count for head in prof_heads[end:]]
+    if end > start:
+        for pid in prof_ids[start:end]:
+            prof_grams.pop(pid, None)
+            prof_gens.pop(pid, None)
+        del prof_ids[start:end]
+        id_nums.clear()
+        sort_stack.clear()
+        shown_profs = [num if num < start else num - (end - start) for num in shown_profs if not start <= num < end]
+    bump(*([owner] if owner is not None else []))
+    search_stale = bool(search)
+
+def set_line(index, value, pid=None):
+    global search_stale
+    if profiles[index] == value:
+        return
+    if (profiles[index][0] == '\t') != (value[0] == '\t'):     # a host became a header or vice versa
+        if index == 0:
+            msgq.append('The first profile can not become a host, there is no profile above it')
+            return
+        journal('s', index, value)
+        retype_line(index, value, pid)
+        return
+    journal('s', index, value)
+    num = prof_num(index)
+    record('s', prof_ids[num], index - prof_heads[num], profiles[index])
+    index_grams(index, -1)
+    forget_parsed(index)
+    profiles[index] = value
+    index_grams(index, 1)
+    bump(num)
+    if search:
+        search_stale = True
+    elif value[0] != '\t':
+        sort_stack.clear()
+        num = bisect_left(prof_heads, index)
+        shown = bisect_left(shown_profs, num)
+        is_shown = shown < len(shown_profs) and shown_profs[shown] == num
+        if pattern.match(value) and not is_shown:
+            shown_profs.insert(shown, num)
+        elif not pattern.match(value) and is_shown:
+            del shown_profs[shown]
+
+# A host turned into a header splits its profile, the hosts below it go to the new profile. A header turned into a host
+# merges its profile into the one above. The profile ids are kept, so that the history of the merged profile is still
+# valid once the merge is undone (pid is the id the split profile gets back). A split is undone by joining the new
+# profile back to the end of the one it was split from, wherever the sorting has moved it
+def retype_line(index, value, pid=None):
+    global shown_profs, search_stale
+    num = prof_num(index)
+    end = prof_end(num)
+    for i in range(index, end):
+        index_grams(i, -1)
+        forget_parsed(i)
+    old, profiles[index] = profiles[index], value
+    if value[0] != '\t':
+        prof_heads.insert(num + 1, index)
+        prof_ids.insert(num + 1, next(prof_id) if pid is None else pid)
+        record('j', prof_ids[num], index - prof_heads[num], old, prof_ids[num + 1])
+        shown_profs = [shown if shown <= num else shown + 1 for shown in shown_profs]
+        if not search and pattern.match(value):
+            insort(shown_profs, num + 1)
+        changed = (num, num + 1)
+    else:
+        record('sp', prof_ids[num - 1], index - prof_heads[num - 1], old, prof_ids[num])
+        prof_grams.pop(prof_ids[num], None)
+        prof_gens.pop(prof_ids[num], None)
+        del prof_heads[num]
+        del prof_ids[num]
+        shown_profs = [shown if shown < num else shown - 1 for shown in shown_profs if shown != num]
+        changed = (num - 1,)
+    for i in range(index, end):
+        index_grams(i, 1)
+    id_nums.clear()
+    sort_stack.clear()
+    bump(*changed)
+    search_stale = bool(search)
+
+def prof_end(num):
+    return prof_heads[num + 1] if num + 1 < len(prof_heads) else len(profiles)
+
+def prof_num(index):
+    return bisect_right(prof_heads, index) - 1
+
+def forget_parsed(index):
+    if profiles[index][0] != '\t':
+        for key in [key for key in list(parsed_conns) if key[0] == profiles[index]]:
+            parsed_conns.pop(key, None)
+    else:
+        parsed_conns.pop((profiles[prof_heads[prof_num(index)]], profiles[index]), None)
+
+def find_profile(header):
+    return [head for head in prof_heads if profiles[head] == header][0]
+
+def id_num(pid):
+    if not id_nums:
+        id_nums.update((pid, num) for num, pid in enumerate(prof_ids))
+    return id_nums.get(pid)
+
+
+# Undo history is a log of the inverse operations recorded by the helpers above, addressed by stable profile ids and
+# offsets from the profile's header, so it survives renames and sorting. Everything changed by one keypress is a single
+# entry (a paste of details over hundreds of hosts is undone at once). Applying an entry through the same helpers
+# records its own inverse, which becomes the entry of the opposite log. Host changes of a single profile are kept
+# in the profile's scope, everything else in the 'outer' one. At most undo_limit lines are kept over all of the entries
+def record(*op):
+    change_ops.append(op)
+
+def close_change():
+    global change_ops
+    if not change_ops:
+        return
+    ops, change_ops = change_ops, []
+    scope = change_scope(ops)
+    push_history(undo_log, scope, ops)
+    drop_history(redo_log, scope)
+
+def change_scope(ops):
+    pids = {op[1] if op[0] in ('r', 'i', 's') and op[2] > 0 else 'outer' for op in ops}
+    return pids.pop() if len(pids) == 1 else 'outer'
+
+def ops_size(ops):
+    return sum(len(op[3]) if op[0] == 'i' else sum(len(block) for _, block in op[1]) if op[0] == 'ip' else 1 for op in ops)
+
+def push_history(log, scope, ops, seq=None):
+    global history_lines
+    log.setdefault(scope, deque()).append((next(history_seq) if seq is None else seq, ops))
+    history_lines += ops_size(ops)
+    while history_lines > int(cfg['undo_limit']):
+        entries = [(queue[0][0], queue, oldlog, oldscope) for oldlog in (undo_log, redo_log) for oldscope, queue in oldlog.items()]
+        _, queue, oldlog, oldscope = min(entries, key=lambda entry: entry[0])
+        if queue is log[scope] and len(queue) == 1:
+            break
+        history_lines -= ops_size(queue.popleft()[1])
+        if not queue:
+            del oldlog[oldscope]
+
+def pop_history(log, scope):
+    global history_lines
+    _, ops = log[scope].pop()
+    history_lines -= ops_size(ops)
+    if not log[scope]:
+        del log[scope]
+    return ops
+
+def drop_history(log, scope):
+    global history_lines
+    for _, ops in log.pop(scope, ()):
+        history_lines -= ops_size(ops)
+
+def clear_history():
+    global history_lines
+    undo_log.clear()
+    redo_log.clear()
+    change_ops.clear()
+    history_lines = 0
+
+def apply_history(source, target, scope):
+    global change_ops
+    close_change()
+    for op in reversed(pop_history(source, scope)):
+        apply_op(op)
+    ops, change_ops = change_ops, []
+    push_history(target, scope, ops)
+    return ops
+
+def apply_op(op):
+    if op[0] in ('r', 'i', 's', 'sp'):
+        head = prof_heads[id_num(op[1])]
+    match op[0]:
+        case 'r':
+            remove_lines(head + op[2], op[3])
+        case 'i':
+            insert_lines(head + op[2], op[3])
+        case 's':
+            set_line(head + op[2], op[3])
+        case 'sp':
+            set_line(head + op[2], op[3], op[4])
+        case 'j':
+            num = id_num(op[4])
+            block = profiles[prof_heads[num]:prof_end(num)]
+            if prof_heads[num] != prof_end(id_num(op[1])):
+                remove_lines(prof_heads[num], len(block))
+                insert_lines(prof_end(id_num(op[1])), block, [op[4]])
+            set_line(prof_end(id_num(op[1])), op[3])
+        case 'rp':
+            for pid in op[1]:
+                num = id_num(pid)
+                remove_lines(prof_heads[num], prof_end(num) - prof_heads[num])
+        case 'ip':
+            num = id_num(op[2]) if op[2] is not None else len(prof_heads)
+            index = len(profiles) if num == len(prof_heads) else prof_heads[num] if num is not None else 0
+            insert_lines(index, [line for _, block in op[1] for line in block], [pid for pid, _ in op[1]])
+
+# The history can be kept between the sessions in {file_path}.undo (encrypted as the main file is),
+# with the profile ids replaced by the ordinals of the profiles in the saved file
+def save_history():
+    if not int(cfg['undo_persist']):
+        return
+    ordinals = {pid: num for num, pid in enumerate(prof_ids)}
+    key_of = lambda pid: pid if pid == 'outer' or pid is None else ordinals.get(pid, -pid - 1)
+    convert = lambda ops: [[op[0], [key_of(pid) for pid in op[1]]] if op[0] == 'rp' else
+                           [op[0], [[key_of(pid), block] for pid, block in op[1]], key_of(op[2])] if op[0] == 'ip' else
+                           [op[0], key_of(op[1]), op[2], op[3], key_of(op[4])] if op[0] in ('sp', 'j') else
+                           [op[0], key_of(op[1]), *op[2:]] for op in ops]
+    history = {name: [[key_of(scope), [[seq, convert(ops)] for seq, ops in queue]] for scope, queue in log.items()]
+               for name, log in (('undo', undo_log), ('redo', redo_log))}
+    # it holds the old versions of the records, so it is kept as private as the journal is
+    with os.fdopen(os.open(f'{mainfile}.undo', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        f.write(encode_record((file_digest(mainfile), history)))
+    os.chmod(f'{mainfile}.undo', 0o600)
+
+def load_history():
+    global history_seq
+    if not int(cfg['undo_persist']) or not os.path.isfile(f'{mainfile}.undo'):
+        return
+    try:
+        with open(f'{mainfile}.undo') as f:
+            digest, history = decode_record(f.read())
+    except Exception:
+        wrt(traceback.format_exc())
+        return
+    if digest != file_digest(mainfile):
+        return
+    fresh = {}
+    pid_of = lambda key: key if key == 'outer' or key is None else prof_ids[key] if key >= 0 else fresh.setdefault(key, next(prof_id))
+    convert = lambda ops: [('rp', [pid_of(key) for key in op[1]]) if op[0] == 'rp' else
+                           ('ip', [(pid_of(key), block) for key, block in op[1]], pid_of(op[2])) if op[0] == 'ip' else
+                           (op[0], pid_of(op[1]), op[2], op[3], pid_of(op[4])) if op[0] in ('sp', 'j') else
+                           (op[0], pid_of(op[1]), *op[2:]) for op in ops]
+    # everything is converted before anything is pushed, a history that does not fit the file is dropped as a whole
+    try:
+        entries = [(log, pid_of(scope), convert(ops), seq) for name, log in (('undo', undo_log), ('redo', redo_log))
+                   for scope, queue in history[name] for seq, ops in queue]
+    except Exception:
+        wrt(f'The undo history in {mainfile}.undo does not match the profiles and was discarded')
+        return
+    for entry in entries:
+        push_history(*entry)
+    history_seq = count(max((entry[0] for log in (undo_log, redo_log) for queue in log.values() for entry in queue), default=0) + 1)
+
+
+# Every change made through the helpers above is appended to {mainfile}.journal, each batch of records encrypted the same
+# way as the main file is, so a killed session loses nothing. Every journal_compact records the writer thread compacts it:
+# a snapshot is written to a temporary file and renamed over the main file, after which the journal starts over.
+# The first record holds a digest of the main file, so a journal left behind by an older snapshot is never replayed
+def journal(*record):
+    global journal_count
+    if journal_path is None:
+        return
+    with journal_cond:
+        journal_queue.append(record)
+        journal_cond.notify()
+    journal_count += 1
+    if journal_count >= int(cfg['journal_compact']):
+        compact_journal()
+
+def compact_journal():
+    global journal_count
+    if journal_path is None:
+        return
+    journal_count = 0
+    with journal_cond:
+        journal_queue.append(('snapshot', list(profiles)))
+        journal_cond.notify()
+
+def open_journal():
+    global journal_path, journal_writer
+    if not int(cfg['journal']) or not os.path.isfile(mainfile) or not ('plain' in filetype or 'pgp-encrypted' in filetype):
+        return
+    journal_path = f'{mainfile}.journal'
+    journal_writer = threading.Thread(target=__journal_writer, daemon=True)
+    journal_writer.start()
+
+# The writer is stopped and waited for, however long it takes, as a snapshot it is still writing
+# would otherwise be renamed over the main file saved on exit
+def close_journal():
+    global journal_path
+    if journal_path is None:
+        return
+    with journal_cond:
+        journal_queue.append(('stop',))
+        journal_cond.notify()
+    journal_writer.join()
+    path, journal_path = journal_path, None
+    return path
+
+def __journal_writer():
+    global journal_compacted
+    jf = os.fdopen(os.open(journal_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600), 'a')
+    if jf.tell() == 0:
+        jf.write(journal_line([('base', file_digest(mainfile))]))
+    while True:
+        with journal_cond:
+            journal_cond.wait_for(lambda: journal_queue)
+            batch = list(journal_queue)
+        records = []
+        for record in batch:
+            if record[0] == 'snapshot':
+                records = []        # already part of the snapshot
+                write_snapshot(record[1])
+                jf.truncate(0)
+                jf.write(journal_line([('base', file_digest(mainfile))]))
+                journal_compacted = True
+            elif record[0] != 'stop':
+                records.append(record)
+        if records:
+            jf.write(journal_line(records))
+        jf.flush()
+        os.fsync(jf.fileno())
+        with journal_cond:
+            for _ in batch:
+                journal_queue.popleft()
+            journal_cond.notify_all()
+        if batch[-1][0] == 'stop':
+            jf.close()
+            return
+
+# A plain journal has a record per line, an encrypted one has a line per batch, so gpg is run once per batch
+def journal_line(records):
+    if 'pgp-encrypted' not in filetype:
+        return ''.join(json.dumps(record) + '\n' for record in records)
+    return encode_record(records) + '\n'
+
+def journal_records(line):
+    if 'pgp-encrypted' not in filetype:
+        return [json.loads(line)]
+    return decode_record(line)
+
+def encode_record(record):
+    data = json.dumps(record)
+    if 'pgp-encrypted' not in filetype:
+        return data
+    return base64.b64encode(gpg.encrypt(data, recipients=None, symmetric=True, passphrase=key, armor=False).data).decode()
+
+def decode_record(line):
+    if 'pgp-encrypted' not in filetype:
+        return json.loads(line)
+    return json.loads(str(gpg.decrypt(base64.b64decode(line), passphrase=key)))
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+# The snapshot is created readable only by the user and then gets the permissions of the file it replaces
+def write_snapshot(lines):
+    tmp = f'{mainfile}.tmp'
+    data = ''.join(lines).encode()
+    if 'pgp-encrypted' in filetype:
+        data = gpg.encrypt(data, recipients=None, symmetric=True, passphrase=key).data
+    with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.chmod(tmp, stat.S_IMODE(os.stat(mainfile).st_mode))
+    os.replace(tmp, mainfile)
+
+# Returns the number of the records applied, so that only a journal that has changed something gets compacted
+def replay_journal():
+    if not os.path.isfile(f'{mainfile}.journal'):
+        return 0
+    with open(f'{mainfile}.journal') as f:
+        lines = f.readlines()
+    applied = 0
+    try:
+        if not lines or journal_records(lines[0]) != [['base', file_digest(mainfile)]]:
+            os.remove(f'{mainfile}.journal')   # the main file was saved after this journal was written
+            return 0
+        for line in lines[1:]:
+            for record in journal_records(line):
+                apply_record(profiles, record)
+                applied += 1
+    except Exception:
+        msgq.append(f'Journal record {applied + 1} could not be replayed, the changes starting from it are kept in {mainfile}.journal.broken')
+        wrt(traceback.format_exc())
+        os.replace(f'{mainfile}.journal', f'{mainfile}.journal.broken')
+        return applied
+    if applied:
+        msgq.append(f'Recovered {applied} changes from the journal of a session that was not finished properly')
+    return applied
+
+def apply_record(lines, record):
+    if record[0] == 'i':
+        lines[record[1]:record[1]] = record[2]
+    elif record[0] == 'r':
+        del lines[record[1]:record[1] + record[2]]
+    elif record[0] == 's':
+        lines[record[1]] = record[2]
+    elif record[0] == 'sort':
+        lines[:] = sort_lines(lines)
+
+
+# Search mode looks through every field of every record (except the secrets) using the trigram inverted index.
+# The index is built on the first search and from then on is updated by the same helpers that change profiles.
+# The helpers only mark the results stale, they are ranked again once per operation, right before the redraw
+def record_fields(line):
+    fields = line.strip().lower().split('\t')
+    details = 2 if line[0] == '\t' else 1     # only the details may hold secrets, the names and addresses are kept as is
+    if len(fields) > details:
+        fields[details] = hide_sensitive(fields[details])
+    return fields
+
+def record_grams(line):
+    grams = set()
+    for field in record_fields(line):
+        if 0 < len(field) < 3:
+            grams.add(field)
+        grams.update(field[i:i + 3] for i in range(len(field) - 2))
+    return grams
+
+def index_grams(index, sign):
+    if not search_ready:
+        return
+    pid = prof_ids[prof_num(index)]
+    grams = prof_grams.setdefault(pid, Counter())
+    for gram in record_grams(profiles[index]):
+        grams[gram] += sign
+        if grams[gram] <= 0:
+            del grams[gram]
+            search_grams[gram].discard(pid)
+        elif grams[gram] == 1:
+            search_grams.setdefault(gram, set()).add(pid)
+
+def build_search():
+    global search_ready
+    search_ready = True
+    for num, pid in enumerate(prof_ids):
+        grams = prof_grams[pid] = Counter()
+        for line in islice(profiles, prof_heads[num], prof_end(num)):
+            grams.update(record_grams(line))
+        for gram in grams:
+            search_grams.setdefault(gram, set()).add(pid)
+
+# Profiles are ranked by how well their name matches the query, then by the number of records having all of its trigrams
+def search_profiles(query):
+    if not search_ready:
+        build_search()
+
+    grams = sorted({query[i:i + 3] for i in range(len(query) - 2)}, key=lambda gram: len(search_grams.get(gram, ())))
+    # queries shorter than a trigram would have to go through every gram of the index, scanning the records is cheaper
+    if len(query) < 3:
+        matches = {}
+        for num, pid in enumerate(prof_ids):
+            hits = sum(1 for line in islice(profiles, prof_heads[num], prof_end(num)) if any(query in field for field in record_fields(line)))
+            if hits:
+                matches[pid] = hits
+    elif grams[0] not in search_grams:
+        return []
+    else:
+        candidates = search_grams[grams[0]].intersection(*[search_grams.get(gram, ()) for gram in grams[1:]])
+        matches = {pid: min(prof_grams[pid][gram] for gram in grams) for pid in candidates}
+
+    ranked = []
+    for pid, hits in matches.items():
+        num = id_num(pid)
+        name = profiles[prof_heads[num]].split('\t')[0].strip().lower()
+        score = 2 if name.startswith(query) else 1 if query in name else 0
+        ranked.append((-score, -hits, num))
+    return [num for _, _, num in sorted(ranked)]
+
 def macros(signal, frame):
     client = tmux_exec("list-client -f '#{==:#{client_control_mode},0}' -F '#{client_tty}'", output=1).strip()
     try:
@@ -308,17 +1196,25 @@ def macros(signal, frame):
     tmux_exec(cmd)
 
 
-def monitor_process(proc):
-    rc = proc.wait()
-    stdout = proc.stdout.read().decode().strip()
-    stderr = proc.stderr.read().decode().strip()
-    cmd = ' '.join(proc.args)
-    templ = []
-    for name, commands in cfg['templ_list'].items():
-        if cmd in commands:
-            templ.append(name)
-            cfg['templ_list'][name] = commands.replace(f'#{{{cmd}}}', stdout)
-    templ = ' and '.join(templ)
+# Every #{...} command runs concurrently and is killed after templ_timeout seconds, connections using
+# a template wait for its commands in wait_templ(), while the rest of the program is not affected at all
+def monitor_process(proc, cmd):
+    try:
+        stdout, stderr = proc.communicate(timeout=int(cfg['templ_timeout']))
+        rc = proc.returncode
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        stdout, stderr = proc.communicate()
+        rc = f'killed after {cfg["templ_timeout"]} seconds'
+    stdout, stderr = stdout.decode().strip(), stderr.decode().strip()
+    templ = ' and '.join(substitute_templ(cmd, stdout))
+    if rc == 0 and stdout:
+        write_templ_cache(cmd, stdout)
+    with templ_cond:
+        templ_pending.discard(cmd)
+        templ_cond.notify_all()
+    if not templ_pending:
+        msgq.append('Template substitution finished')
 
     if rc != 0:
         msgq.append(f'Execution of "{cmd}" as part of "{templ}" template has returned a non-zero ({rc}) return code and the following came to the stderr:\n{stderr}\n'\
@@ -334,7 +1230,7 @@ def neighbors(signal, frame):
     client = tmux_exec("list-client -f '#{==:#{client_control_mode},0}' -F '#{client_tty}'", output=1).strip()
     pid = os.getpid()
     try:
-        index = [i for i, v in enumerate(profiles) if not v.startswith('\t') and name in v.split('\t')[0]][0]
+        index = [head for head in prof_heads if name in profiles[head].split('\t')[0]][0]
     except IndexError:
         tmux_exec(f"display-message -c {client} -d 3000 'There is no profile with the \"{name}\" name'")
         return
@@ -372,42 +1268,67 @@ def neighbors(signal, frame):
                 conn_num += 1
 
         try:
-            create_connection(tmux_exec('split-window -P -F " #{pane_id}"', output=1).strip(), conn_num, index)
+            schedule_connection(tmux_exec('split-window -P -F "#{pane_id}"', output=1).strip(), conn_num, index)
             tmux_exec('set-environment -u neighbor')
         except Exception:
             tmux_exec(f'kill-pane\n \
                     display-message -c {client} -d 3000 "Could not parse chosen host configuration"')
 
+# Commands are written to the control mode client right away and every one of them gets a future, which is resolved
+# by __tmux_reader() once the matching %begin/%end block arrives, so many commands can be in flight at the same time
 def tmux_exec(cmd, output=0):
+    futures = tmux_submit(cmd)
+    if not output:
+        return ''
+    try:
+        lines = futures[0].result(timeout=int(cfg['tmux_timeout']))
+    except FutureTimeoutError:
+        wrt(f'tmux did not answer to "{cmd}" in {cfg["tmux_timeout"]} seconds')
+        return ''
+    return ''.join(line + '\n' for line in lines[:output])
+
+def tmux_submit(cmd):
     if tmux.poll() is not None:
         if not start_tmux():
             raise AssertionError
-    lock.acquire()
-    if cmd.startswith('capture'):
-        os.set_blocking(tmux.stdout.name, False)
-    ret = __tmux_exec(cmd, output)
-    if not os.get_blocking(tmux.stdout.name):
-        os.set_blocking(tmux.stdout.name, True)
-    lock.release()
-    return ret
-
-
-def __tmux_exec(cmd, output):
-    tmux.stdin.write(cmd + '\n')
-    if output:
-        sleep(0.01)
-        while True:
-            try:
-                line = tmux.stdout.readline()
-            except Exception:
-                return ''
-            if line.startswith('%begin'):
-                line = tmux.stdout.readline()
-                if not line.startswith('%'):
-                    return (line if line != '\n' else '') + ''.join(filter(lambda x: x != '\n', [tmux.stdout.readline() for i in range(output - 1)]))
+    futures = []
+    with lock:
+        for line in filter(str.strip, cmd.split('\n')):    # an empty line would detach the control mode client
+            futures.append(Future())
+            tmux_pending.append((line, futures[-1]))
+            tmux.stdin.write(line + '\n')
+        tmux.stdin.flush()
+    return futures
+
+
+# Every tmux process gets a reader and a pending queue of its own, so that a reader of the process that has exited
+# only fails the commands sent to it and not the ones sent to the process started in its place
+def __tmux_reader(proc, pending):
+    block = begin = None
+    for line in proc.stdout:
+        line = line.rstrip('\n')
+        if block is None:
+            if line.startswith('%begin '):
+                block, begin = [], line.split(' ')[1:]
+            continue
+        guard = line.split(' ')
+        if guard[0] not in ('%end', '%error') or guard[1:] != begin:
+            block.append(line)
+            continue
+        if begin[2] == '1':         # only the blocks for the commands sent by this client, the rest are not awaited
+            cmd, future = pending.popleft()
+            if guard[0] == '%error':
+                wrt(f'tmux returned an error for "{cmd}": ' + ' '.join(block))
+                block = []
+            future.set_result(block)
+        block = None
+
+    while pending:
+        pending.popleft()[1].set_result([])
+    proc.wait()     # SIGCHLD is left at its default, so the exited tmux has to be reaped here
 
 def normalexit(signal, frame):
-    global profiles, key, focused, nodetails, debug
+    global profiles, key, focused, nodetails, debug, filetype
     if focused:
         focused = False
         nodetails = False
@@ -415,23 +1336,27 @@ def normalexit(signal, frame):
         curses.curs_set(0)
         redraw()
 
-    if profs_hash == hash(str(profiles)):
+    journal_file = close_journal()
+    if generation == saved_generation and not journal_compacted:
+        if journal_file:
+            os.remove(journal_file)
         deinitialize_scr()
     
+    wrt(f'{len(changed_profiles(saved_generation))} profiles were changed during the session, saving them to {mainfile}')
     sort_profiles()
     encrypt = True
     if not os.path.isfile(mainfile):    # File does not exist, try to encrypt by default
-        if KEYRING and GNUPG:
+        if init_keyring() and init_gnupg():
             key = token_urlsafe(64)
             keyring.set_password(mainfile, getuser(), key)
 
     elif 'plain' in filetype:           # File does exist, but for some reason in plain text, offer encryption
-        if not cfg['never_ask_for_encryption'] and GNUPG:
+        if not cfg['never_ask_for_encryption'] and init_gnupg():
             deinitialize_scr(noexit=True)
             option = input("Would you like to encrypt the file? (y - generate passphrase and save it to local keyring, n - don't encrypt, m - manually specified passphrase): ").lower()
 
             if option == 'y':
-                if KEYRING:
+                if init_keyring():
                     key = token_urlsafe(64)
                     keyring.set_password(mainfile, getuser(), key)
                 else:
@@ -439,7 +1364,8 @@ def normalexit(signal, frame):
 
             elif option == 'm':
                 key = getpass('Enter the passphrase: ')
-                keyring.set_password(mainfile, getuser(), key)
+                if init_keyring():
+                    keyring.set_password(mainfile, getuser(), key)
 
             elif option == 'n':
                 encrypt = False
@@ -449,17 +1375,60 @@ def normalexit(signal, frame):
                 print('Unrecognized option was entered, file will be saved in plain text')
                 encrypt = False
 
-    if encrypt:
+    if encrypt and init_gnupg():
         gpg.encrypt(''.join(profiles), recipients=None, symmetric=True, passphrase=key, output=mainfile)
+        filetype = 'pgp-encrypted'
     else:
         with open(mainfile, 'w') as f:
             for line in profiles:
                 f.write(line)
+        filetype = 'plain'
+    close_change()
+    save_history()
+    if journal_file:
+        os.remove(journal_file)
     try:
         deinitialize_scr()
     except:
         exit()
 
+def substitute_templ(cmd, stdout):
+    templ = []
+    with templ_cond:
+        for name, commands in cfg['templ_list'].items():
+            if cmd in commands:
+                templ.append(name)
+                cfg['templ_list'][name] = commands.replace(f'#{{{cmd}}}', stdout)
+        parsed_conns.clear()
+    return templ
+
+def wait_templ(name):
+    with templ_cond:
+        return templ_cond.wait_for(lambda: not any(f'#{{{cmd}}}' in cfg['templ_list'][name] for cmd in templ_pending),
+                                   timeout=int(cfg['templ_timeout']) + 1)
+
+# The outputs are kept in templ_cache for templ_cache_ttl seconds, nothing is stored with the default of 0
+def read_templ_cache():
+    if not int(cfg['templ_cache_ttl']):
+        return {}
+    try:
+        with open(f'{userdir}/templ_cache') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {cmd: value for cmd, value in cache.items() if time() - value[0] < int(cfg['templ_cache_ttl'])}
+
+def write_templ_cache(cmd, stdout):
+    if not int(cfg['templ_cache_ttl']):
+        return
+    with templ_cond:
+        cache = read_templ_cache()
+        cache[cmd] = (time(), stdout)
+        fd = os.open(f'{userdir}/templ_cache.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, 'w') as f:
+            json.dump(cache, f)
+        os.replace(f'{userdir}/templ_cache.tmp', f'{userdir}/templ_cache')
+
 def parse_config():
     try:
         config_file = open(f'{userdir}/config')
@@ -481,7 +1450,12 @@ def parse_config():
 
     for key, value in tmpcfg.items():
         # numerical parameters
-        if key in ('never_ask_for_encryption', 'port', 'local_spacing', 'wf_timeout', 'select_multiplier', 'max_conn_displayed', 'src_tunnel_port', 'dst_tunnel_port'):
+        if key in ('never_ask_for_encryption', 'port', 'local_spacing', 'wf_timeout', 'select_multiplier', 'max_conn_displayed', 'src_tunnel_port', 'dst_tunnel_port', 'tmux_timeout', 'panes_per_window',
+                   'max_connecting', 'max_per_profile', 'max_per_jump', 'conn_rate', 'wf_retries', 'max_children',
+                   'tunnel_probe_timeout', 'tunnel_restarts', 'tunnel_backoff_max', 'control_master', 'control_persist',
+                   'log_max_size', 'log_keep', 'log_compress', 'tail_fps',
+                   'templ_timeout', 'templ_cache_ttl', 'journal', 'journal_compact',
+                   'undo_limit', 'undo_persist', 'import_cidr_limit'):
             if key in ('src_tunnel_port', 'dst_tunnel_port') and ',' in value:
                 ports = []
                 invalids = []
@@ -499,6 +1473,9 @@ def parse_config():
             elif not value.isdigit():
                 msgq.append(f'{key} was defined, but is not integer')
                 continue
+            elif key in ('panes_per_window', 'max_connecting') and int(value) < 1:
+                msgq.append(f'{key} was defined, but is less than 1')
+                continue
 
         # local paths
         if key in ('file_path', 'logfile', 'upload_from_dest', 'keys_path', 'from_scripts_path', 'to_scripts_path'):
@@ -539,9 +1516,15 @@ def parse_config():
             for templ in map(str.strip, templs):
                 name, commands = templ.split('=')
                 cfg['templ_list'][name] = commands
-            for extcmd in set(re.findall(r'#\{(.*?)\}', ''.join(cfg['templ_list'].values()))):
+            extcmds = set(re.findall(r'#\{(.*?)\}', ''.join(cfg['templ_list'].values())))
+            cache = read_templ_cache()
+            for extcmd in extcmds:
+                if extcmd in cache:
+                    substitute_templ(extcmd, cache[extcmd][1])
+                    continue
+                templ_pending.add(extcmd)
                 proc = subprocess.Popen(extcmd.split(' '), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                threading.Thread(target=monitor_process, args=[proc], daemon=True).start()
+                threading.Thread(target=monitor_process, args=[proc, extcmd], daemon=True).start()
 
     if 'new_profile:\n' in lines:
         proflines = []
@@ -563,7 +1546,31 @@ def parse_config():
         cfg['new_profile'] = ['New profile\n', '\tnew\t10.100.0.0\n']
 
 
+# The whole layout of windows and panes is sent to tmux at once, titles are set to the pane made active by the split
+# and the actual pane ids are read back from the -P output instead of being guessed
+def plan_panes(winname, panenames):
+    cmds = []
+    creating = []
+    for counter, panename in enumerate(panenames):
+        if counter % int(cfg['panes_per_window']) == 0:
+            cmds.append(f'new-window -n "{winname}" -P -F "#{{pane_id}}"')
+        else:
+            cmds.append('split-window -P -F "#{pane_id}"')
+        creating.append(len(cmds) - 1)
+        cmds.append(f'select-pane -T "{panename}"')
+        cmds.append('select-layout tiled')
+
+    futures = tmux_submit('\n'.join(cmds))
+    panes = []
+    for index in creating:
+        try:
+            panes.append((futures[index].result(timeout=int(cfg['tmux_timeout'])) or [''])[0].strip())
+        except FutureTimeoutError:
+            panes.append('')
+    return panes
+
 def print_message(text, offset=tabsize, voffset=0, cursesoptions=0):
+    frame.clear()
     conn = profiles[resolve('conn')]
     print_point = len(conn.expandtabs().rstrip()) + offset
     if nodetails:
@@ -602,164 +1609,356 @@ def print_message(text, offset=tabsize, voffset=0, cursesoptions=0):
     scr.refresh()
 
 
-# The only function responsible for printing everything displayed on the screen, called only in redraw()
-# It has been proved to be easier to redraw everything with each motion
+# The only function responsible for composing everything displayed on the screen, called only in redraw()
+# It is still easier to compose everything with each motion, but only the rows that differ from the previous frame are drawn
 def print_profiles(move):
     global profiles_count, conn_count
-    profiles_count = len([i for i in profiles if i[0] != '\t' and pattern.match(i)][topprof:])
+    profiles_count = max(len(shown_profs) - topprof, 0)
 
+    rows = {}
     pntr = 0
-    for prof in [i for i in profiles if i[0] != '\t' and pattern.match(i)][topprof:]:
+    for num in shown_profs[topprof:topprof + curses.LINES]:
+        prof = profiles[prof_heads[num]]
         if pntr + 3 == curses.LINES:
-            return
+            return rows
 
         if pntr == highlstr:
             changes_hint = ''
             if not nodetails:
-                undo_count = len(undo_changes.get(prof if nested else 'outer', []))
-                redo_count = len(redo_changes.get(prof if nested else 'outer', []))
+                undo_count = len(undo_log.get(prof_ids[num] if nested else 'outer', ()))
+                redo_count = len(redo_log.get(prof_ids[num] if nested else 'outer', ()))
                 changes_hint = (f'{undo_count} changes to undo' if undo_count else '') + \
                                (' and ' if undo_count and redo_count else '') + \
                                (f'{redo_count} {"changes " if not undo_count else ""}to redo' if redo_count else '')
 
             profname, conndetails = (prof + '\t').split('\t')[:2]
             conndetails = hide_sensitive(conndetails)
-            scr.addstr(pntr, 0, profname.rstrip('\n'), curses.A_BOLD)
-            scr.addstr(('\t' if conndetails else '') + conndetails.rstrip('\n'), curses.A_DIM + curses.A_ITALIC)
+            rows[pntr] = [(0, profname.rstrip('\n'), curses.A_BOLD),
+                          (None, ('\t' if conndetails else '') + conndetails.rstrip('\n'), curses.A_DIM + curses.A_ITALIC)]
             if changes_hint:
-                scr.addstr('\t[', curses.A_DIM)
-                scr.addstr(changes_hint, curses.A_DIM + curses.A_UNDERLINE)
-                scr.addstr(']\n', curses.A_DIM) 
-            scr.addstr('\n')
-
-            conn_list = []
-            conns_to_draw = []
-            for i in profiles[resolve('prof') + 1:]:
-                if not i.startswith('\t'): break
-                conn_list.append(i)
-            conn_count = len(conn_list)
-
-            for counter, i in enumerate(conn_list[topconn:]):
-                if counter == max_displayed - 1:
-                    break
-                conns_to_draw.append('\t'.join(i.split('\t')[:3]) if nodetails else i)
+                rows[pntr] += [(None, '\t[', curses.A_DIM), (None, changes_hint, curses.A_DIM + curses.A_UNDERLINE), (None, ']', curses.A_DIM)]
+
+            # only the hosts fitting into the viewport are taken from the list, so the size of a profile does not matter
+            first = prof_heads[num] + 1 + topconn
+            conn_count = prof_end(num) - prof_heads[num] - 1
+            conns_to_draw = [('\t'.join(i.split('\t')[:3]) if nodetails else i) for i in profiles[first:min(first + max_displayed - 1, prof_end(num))]]
 
             if topconn: conns_to_draw[0] = f'\t...\t{topconn + 1} hosts above'
             if max_displayed + topconn < conn_count: conns_to_draw[-1] = f'\t...\t{conn_count - max_displayed - topconn + 1} hosts below'
 
             for index, conn in enumerate(conns_to_draw, 1):
                 if pntr == curses.LINES - 4:
-                    return
+                    return rows
                 pntr += 1
                 params = conn.split('\t')[-1]
-                conn = conn.replace(params, hide_sensitive(params))
+                conn = conn.replace(params, hide_sensitive(params)).rstrip('\n')
                 if (conn.startswith('\t#') or conn.startswith('\t...')) and index != move - highlstr:
-                    scr.addstr(pntr, 0, conn, curses.A_DIM + curses.A_ITALIC)
+                    rows[pntr] = [(0, conn, curses.A_DIM + curses.A_ITALIC)]
                     continue
                 if index + topconn in picked_cons and not conn.startswith('\t...'):
                     if index == move - highlstr:
-                        scr.addstr(pntr, 4, conn, curses.A_REVERSE)
+                        rows[pntr] = [(4, conn, curses.A_REVERSE)]
                         continue
-                    scr.addstr(pntr, 0, conn, curses.A_REVERSE)
+                    rows[pntr] = [(0, conn, curses.A_REVERSE)]
                     continue
                 if index == move - highlstr:
-                    scr.addstr(pntr, 8, conn[1:], curses.A_REVERSE)
+                    rows[pntr] = [(8, conn[1:], curses.A_REVERSE)]
                     continue
 
-                scr.addstr(pntr, 0, conn)
+                rows[pntr] = [(0, conn, 0)]
 
         else:
-            scr.addstr(pntr, 0, prof.split('\t')[0])
+            rows[pntr] = [(0, prof.split('\t')[0].rstrip('\n'), 0)]
         pntr += 1
+    return rows
+
+
+# Rows drawn in the previous frame are compared with the new ones, so a cursor motion rewrites just a couple of lines.
+# Anything drawn over the main screen (messages, input fields, log tailing) has to drop the frame with frame.clear()
+def draw_frame(rows, move):
+    if not frame:
+        scr.erase()
+    try:
+        for row in frame.keys() | rows.keys():
+            if frame.get(row) == rows.get(row):
+                continue
+            scr.move(row, 0)
+            scr.clrtoeol()
+            for x, text, attr in rows.get(row, []):
+                if x is None:
+                    scr.addstr(text, attr)
+                else:
+                    scr.addstr(row, x, text, attr)
+    except curses.error:
+        frame.clear()
+        raise
+    frame.clear()
+    frame.update(rows)
+    scr.move(move, 0)
+    scr.noutrefresh()
+    curses.doupdate()
 
 
 # war crime happenning, i won't disagree, but apparently, ssh's keyboard interactive auth desparetly needs a tty to attach to (apparently, but obviously)
 # and in the context of curses program, a child process attaches to a parent's tty, while i want password to be sent non-interactively
 # just an os.write() to a processe's FD (because password is either already entered for the host or fetched from the template)
 # That's the whole reason for writing this garbage that manually forks and further monitors the output to react with a password
-def proc_handler(cmd, args, waitfor=None):
+def proc_handler(cmd, args, waitfor=None, tunnel=None, transfer=None):
+    global supervisor
+    with children_lock:
+        if len(children) >= int(cfg['max_children']):
+            child_queue.append((cmd, args, waitfor, tunnel, transfer))
+            wrt(f'{cmd} is queued, as there are already {len(children)} processes running')
+            return
+        __spawn_child(cmd, args, waitfor, tunnel, transfer)
+    if supervisor is None:
+        supervisor = threading.Thread(target=__supervise, daemon=True)
+        supervisor.start()
+    os.write(supervisor_wakeup[1], b'.')
+
+def __spawn_child(cmd, args, waitfor, tunnel, transfer):
     pid, fd = os.forkpty()
     if pid == 0:
-        os.execvp(cmd, args)
-    elif pid > 0:
-        threading.Thread(target=__proc_watcher, args=[fd, pid, waitfor, ('-L' in args)], daemon=True).start()
+        os.execvp(cmd, [cmd] + args)
+    os.set_blocking(fd, False)
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):        # no pidfd support, the child is polled with waitpid() instead
+        pidfd = None
+    # the supervisor may be looking at the children right now, so the entry is added only once complete
+    children[pid] = {'fd': fd, 'pidfd': pidfd, 'waitfor': waitfor, 'tunnel': tunnel, 'transfer': transfer, 'output': ''}
+    selector.register(fd, selectors.EVENT_READ, ('output', pid))
+    if pidfd is not None:
+        selector.register(pidfd, selectors.EVENT_READ, ('exit', pid))
+    if tunnel is not None and tunnel in tunnels:
+        tunnels[tunnel][3] = pid
 
 # The second part is only related to the tunnel's monitoring, as its just convinient to create a tunnel with a few keystrokes
 # why not extend this functionality with an ability to both see the tunnel's status and kill/restart it if needed
-def __proc_watcher(fd, pid, waitfor, tunnel):
-    while not (tunnel and not waitfor):
-        try:
-            out = os.read(fd, 1024)
-        except OSError:
-            wrt(f'{pid} has *probably* finished its execution, as os.read() raised an exception on processe\'s FD')
-            return
-        wrt(f'[PID - {pid}] ' + out.decode())
-        if b'word:' in out and waitfor is not None:
-            os.write(fd, f'{waitfor}\n'.encode())
-            waitfor = None
-        sleep(0.1)
-
-    tunid = max(tunnels.keys())
-    sport = tunnels[tunid][0][:tunnels[tunid][0].index(':')]
-    wrt('[' + tunnels[tunid][0] + ']' + ' -> ' + tunnels[tunid][2])
-    prev = tunnels[tunid][2]
-    alivecheck = 0
+# A single thread owns all of the forked processes: it reads their output, answers password prompts and reaps them
+def __supervise():
+    last_check = 0
     while True:
-        sleep(0.1)
-        alivecheck += 1
-        try:
-            if tunnels[tunid][2].startswith('to be'):       # user request for tunnel to be either killed or restarted
-                os.kill(pid, 9)
-                for _ in range(5):
-                    os.kill(pid, 0)
-                    sleep(0.5)
-                wrt(f'[PID - {pid}] is still alive for the past 10 seconds after sending SIGKILL')
-            if alivecheck == 20:
-                alivecheck = 0
-                os.kill(pid, 0)
-                sock = socket.socket()
-                sock.settimeout(10)
-                sock.connect(('127.0.0.1', int(sport)))
-                tunnels[tunid][2] = 'connected'
-                sock.close()
-
-        except ConnectionError as exc:
-            tunnels[tunid][2] = str(exc.args)
-
-        except ProcessLookupError:
-
-            if tunnels[tunid][2].startswith('to be'):
-                wrt(f'[PID - {pid}] was killed by request')
-
-                if tunnels[tunid][2] == 'to be restarted':
-                    params = tunnels[tunid][1]
-                    newtunid = max(tunnels.keys()) + 1
-                    tunnels[newtunid] = tunnels[tunid]
-                    tunnels[newtunid][2] = 'starting'
-                    tailing_print()
-                    wrt(f'\nRestarting a tunnel with the following command:\nssh {" ".join(params[0])}')
-                    proc_handler('ssh', *params)
-                tunnels.pop(tunid)
-
+        for key, _ in selector.select(timeout=1):
+            if key.fileobj == supervisor_wakeup[0]:
+                os.read(supervisor_wakeup[0], 1024)
+                continue
+            event, pid = key.data
+            if event == 'output':
+                __child_output(pid)
+            elif event == 'probe':
+                probe_done(pid)
             else:
-                tunnels[tunid][2] = 'exited'
+                __child_exit(pid)
 
-        finally:
-            if not tunnels.get(tunid):
-                raise AssertionError('Deleted tunnel')
-            elif tunnels[tunid][2] != prev:
-                wrt('[' + tunnels[tunid][0] + ']' + ' -> ' + tunnels[tunid][2])
-                prev = tunnels[tunid][2]
-                if prev == 'exited':
-                    tunnels.pop(tunid)
-                    message = ''
-                    while True:
-                        try:
-                            message += os.read(fd, 1024).decode()
-                        except Exception:
-                            break
-                    wrt(f"The following output was captured:\n{message}")
-                    raise AssertionError('Exited tunnel')
+        for pid in [pid for pid, child in list(children.items()) if child['pidfd'] is None]:
+            __child_exit(pid)
+        if time() - last_check >= 2:
+            last_check = time()
+            check_tunnels()
+
+def __child_output(pid):
+    child = children[pid]
+    try:
+        out = os.read(child['fd'], 4096)
+    except BlockingIOError:
+        return False
+    except OSError:
+        out = b''
+    if not out:
+        selector.unregister(child['fd'])
+        return False
+    wrt(f'[PID - {pid}] ' + out.decode(errors='replace'))
+    child['output'] = (child['output'] + out.decode(errors='replace'))[-4096:]
+    if b'word:' in out and child['waitfor'] is not None:
+        os.write(child['fd'], f'{child["waitfor"]}\n'.encode())
+        child['waitfor'] = None
+    return True
+
+def __child_exit(pid):
+    try:
+        wpid, status = os.waitpid(pid, os.WNOHANG)
+        if wpid == 0:
+            return
+        code = os.waitstatus_to_exitcode(status)
+    except ChildProcessError:
+        code = None
+    child = children[pid]
+    # whatever is already buffered is read once, a descendant still holding the pty open must not keep the supervisor here
+    if child['fd'] in selector.get_map():
+        for _ in range(64):
+            if not __child_output(pid):
+                break
+    for fd in (child['fd'], child['pidfd']):
+        if fd is not None:
+            if fd in selector.get_map():
+                selector.unregister(fd)
+            os.close(fd)
+    with children_lock:
+        children.pop(pid)
+        if child_queue:
+            __spawn_child(*child_queue.popleft())
+
+    if child['transfer'] is not None:
+        transfer_done(*child['transfer'], code, child['output'])
+    tunid = child['tunnel']
+    if tunid is None or tunid not in tunnels:
+        wrt(f'[PID - {pid}] has finished its execution with exit code {code}')
+        return
+    tunnel = tunnels[tunid]
+    tunnel[4]['up_since'] = tunnel[4]['latency'] = None
+    if tunnel[2].startswith('to be'):
+        wrt(f'[PID - {pid}] was killed by request')
+        if tunnel[2] == 'to be restarted':
+            restart_tunnel(tunid)
+        else:
+            tunnels.pop(tunid)
+        return
+    wrt('[' + tunnel[0] + ']' + f' -> exited with exit code {code}')
+    wrt(f"The following output was captured:\n{child['output']}")
+    schedule_restart(tunid)
+
+# Every host of a multi-host transfer is a child of its own, the progress of the whole transfer is summed up here
+def transfer_done(trid, host, code, output):
+    transfer = transfers[trid]
+    transfer[2] += 1
+    if code != 0:
+        transfer[3].append(host)
+        wrt(f'[{transfer[0]}] {host} failed with exit code {code}, the following output was captured:\n{output}')
+    wrt(f'[{transfer[0]}] {transfer[2]} of {transfer[1]} hosts finished, {len(transfer[3])} failed')
+    if transfer[2] < transfer[1]:
+        return
+    transfers.pop(trid)
+    if transfer[3]:
+        wrt(f'[{transfer[0]}] failed for ' + ', '.join(transfer[3]))
+
+def schedule_restart(tunid):
+    tunnel = tunnels[tunid]
+    if tunnel[4]['restarts'] >= int(cfg['tunnel_restarts']):
+        wrt(f'[{tunnel[0]}] was restarted {tunnel[4]["restarts"]} times in a row, giving up')
+        tunnels.pop(tunid)
+        return
+    # a tunnel that keeps dying is restarted less and less often, a tunnel that was up for a while starts over
+    delay = min(2 ** tunnel[4]['restarts'], int(cfg['tunnel_backoff_max']))
+    tunnel[4]['restarts'] += 1
+    tunnel[4]['retry_at'] = time() + delay
+    tunnel[2] = f'exited, restarting in {delay}s'
+
+def restart_tunnel(tunid):
+    with tunnel_lock:
+        if tunid not in tunnels:        # already restarted from the other thread
+            return
+        drop_probe(tunid)
+        newtunid = next(tunnel_id)
+        tunnels[newtunid] = tunnels.pop(tunid)
+        tunnels[newtunid][2] = 'starting'
+        tunnels[newtunid][4]['retry_at'] = None
+    open_tunnel(newtunid, 'Restarting')     # only written to the log, the log view is opened by the user's kill/restart
+
+# A tunnel to a host having a live master connection is only a forwarding added to that master,
+# otherwise a standalone ssh process is started and supervised
+def open_tunnel(tunid, action='Starting'):
+    tunnel = tunnels[tunid]
+    args, passwd = tunnel[1]
+    if master_alive(tunnel[4]['master']):
+        wrt(f'\n{action} a tunnel through the master connection {tunnel[4]["master"]}')
+        if master_command(tunnel, 'forward'):
+            tunnel[2] = 'forwarded'
+            return
+    tunnel[4]['master'] = None
+    wrt(f'\n{action} a tunnel with the following command:\nssh {" ".join(args)}')
+    proc_handler('ssh', args, passwd, tunnel=tunid)
+
+def master_command(tunnel, command):
+    args = tunnel[1][0]
+    res = subprocess.run(['ssh', '-O', command, '-o', f'ControlPath={tunnel[4]["master"]}', '-L', args[args.index('-L') + 1],
+                          args[args.index('-L') + 2]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if res.returncode != 0:
+        wrt(f'[{tunnel[0]}] ssh -O {command} failed: {res.stdout.strip()}')
+    return res.returncode == 0
+
+# Every tunnel's local port is probed with a non-blocking connect, so a stuck tunnel never delays the others
+def check_tunnels():
+    for tunid in [tunid for tunid in probes if tunid not in tunnels]:
+        drop_probe(tunid)
+    for tunid, tunnel in list(tunnels.items()):
+        if tunnel[4]['retry_at'] is not None:
+            if time() >= tunnel[4]['retry_at']:
+                restart_tunnel(tunid)
+            continue
+        if tunid in probes:
+            if time() - probes[tunid][1] >= int(cfg['tunnel_probe_timeout']):
+                probe_done(tunid, 'probe timed out')
+            continue
+        running = tunnel[3] in children and not children[tunnel[3]]['waitfor']
+        if not (running or tunnel[4]['master']) or tunnel[2].startswith('to be'):
+            continue
+        sock = socket.socket()
+        sock.setblocking(False)
+        err = sock.connect_ex(('127.0.0.1', int(tunnel[0][:tunnel[0].index(':')])))
+        probes[tunid] = (sock, time())
+        if err in (0, errno.EINPROGRESS):
+            selector.register(sock, selectors.EVENT_WRITE, ('probe', tunid))
+        else:
+            probe_done(tunid, os.strerror(err))
+
+def drop_probe(tunid):
+    sock, started = probes.pop(tunid, (None, None))
+    if sock is not None:
+        if sock in selector.get_map():
+            selector.unregister(sock)
+        sock.close()
+    return sock, started
+
+def probe_done(tunid, status=None):
+    if tunid not in probes:         # dropped by a restart while its event was already selected
+        return
+    sock = probes[tunid][0]
+    if status is None:
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        status = os.strerror(err) if err else 'connected'
+    _, started = drop_probe(tunid)
+    tunnel = tunnels.get(tunid)
+    if tunnel is None or tunnel[2].startswith('to be'):
+        return
+    prev = tunnel[2]
+    tunnel[2] = status
+    if status == 'connected':
+        tunnel[4]['latency'] = time() - started
+        if tunnel[4]['up_since'] is None:
+            tunnel[4]['up_since'] = time()
+        elif time() - tunnel[4]['up_since'] >= int(cfg['tunnel_backoff_max']):
+            tunnel[4]['restarts'] = 0
+    else:
+        tunnel[4]['up_since'] = tunnel[4]['latency'] = None
+    if tunnel[2] != prev:
+        wrt('[' + tunnel[0] + ']' + ' -> ' + tunnel[2])
+    # a forwarding has no process of its own to exit, so it is restarted once its master is gone
+    if status != 'connected' and tunnel[4]['master'] and not master_alive(tunnel[4]['master']):
+        wrt(f'[{tunnel[0]}] -> the master connection has exited')
+        tunnel[4]['master'] = None
+        schedule_restart(tunid)
+
+def tunnel_status(tunnel):
+    status = '[' + tunnel[0] + ']' + ' -> ' + tunnel[2]
+    if tunnel[4]['latency'] is not None:
+        status += f' ({tunnel[4]["latency"] * 1000:.1f} ms, up for {int(time() - tunnel[4]["up_since"])}s)'
+    return status
+
+def stop_tunnel(tunnel, action):
+    tunnel[2] = action
+    if tunnel[3] in children:
+        os.kill(tunnel[3], signal.SIGKILL)
+        return
+    # the tunnel is either a forwarding of a master connection or its process has already exited
+    # and it is waiting for the automatic restart
+    if tunnel[4]['master']:
+        master_command(tunnel, 'cancel')
+    tunid = next(tunid for tunid, value in tunnels.items() if value is tunnel)
+    if action == 'to be restarted':
+        restart_tunnel(tunid)
+    else:
+        tunnels.pop(tunid)
 
 
 # An essential function, used both for rerendering the whole screen and handling all the movement in its vast complexity
@@ -801,11 +2000,11 @@ def redraw(move=None, breakout=True, sort_profs=False):
 
     if sort_profs:
         sort_profiles()
-    scr.erase()
-    print_profiles(move)
-    scr.addstr(curses.LINES - 2, 4, f'Sort by {sort}.*   Copied details: {copied_details}')
-    scr.move(move, 0)
-    scr.refresh()
+    if search_stale:
+        filter_profiles()
+    rows = print_profiles(move)
+    rows[curses.LINES - 2] = [(4, (f'Search for {search}' if search else f'Sort by {sort}.*') + f'   Copied details: {copied_details}' + connection_queue_hint(), 0)]
+    draw_frame(rows, move)
     if breakout:
         raise AssertionError
 
@@ -818,12 +2017,13 @@ def reset(n=True, h=True, c=True, t=True, r=0):
     topprof = 0 if t else None
     picked_cons = set()
     pattern = re.compile(rf'^{sort}.*|.*\| *{sort}.*', re.I)
+    filter_profiles()
     redraw(r)
 
 # resolve actual position in the profiles list from the relative position on the screen
 def resolve(only_one=None):
     try:
-        prof_index = profiles.index([i for i in profiles if i[0] != '\t' and pattern.match(i)][topprof:][highlstr])
+        prof_index = prof_heads[shown_profs[topprof + highlstr if highlstr >= 0 else highlstr]]
     except Exception:
         return 0
     if only_one == 'prof':
@@ -832,99 +2032,188 @@ def resolve(only_one=None):
         return prof_index + pos
     return prof_index, prof_index + pos
 
-def save_changes(action, location=None, value=None):
-    prof_name = profiles[resolve('prof')]
-    add = lambda change: undo_changes.get(prof_name, []) + [change]
-
-    if isinstance(location, int):
-        location = [location]
-    if value is not None and isinstance(value, str):
-        value = [value]
-    
-    if action == 'edit':
-        if nested:
-            undo_changes[prof_name] = add({'action': 'e', 'location': location, 'value': value})
-        else:
-            undo_changes['outer'].append({'action': 'e', 'name': prof_name, 'value': value})
-            if undo_changes.get(value[0]):
-                undo_changes[prof_name] = undo_changes.pop(value[0])
-
-    if action == 'remove':
-        if nested:
-            undo_changes[prof_name] = add({'action': 'r', 'location': location})
+# The file is read in chunks, so its size does not matter, only the addresses found are kept in memory. Networks are
+# expanded into their hosts unless they have more than import_cidr_limit of them, names need at least two dots
+def read_addresses(filename, progress=None):
+    found = {4: set(), 6: set(), 'name': set(), 'skipped': []}
+    size = os.path.getsize(filename) or 1
+    tail = ''
+    with open(filename, errors='replace') as f:
+        while chunk := f.read(1 << 20):
+            chunk = tail + chunk
+            cut = max(chunk.rfind(char) for char in ' \t\n,;')     # the last token may continue in the next chunk
+            chunk, tail = (chunk[:cut], chunk[cut:]) if cut > 0 else ('', chunk)
+            classify_tokens(address_re.findall(chunk), found)
+            if progress:
+                progress(f.buffer.tell() / size)
+    classify_tokens(address_re.findall(tail), found)
+    # addresses are kept as integers, so they are sorted numerically and only converted back once
+    return [str(ipaddress.IPv4Address(ip)) for ip in sorted(found[4])] + \
+           [str(ipaddress.IPv6Address(ip)) for ip in sorted(found[6])] + sorted(found['name']), found['skipped']
+
+# Only the tokens of a single chunk are deduplicated, remembering every token of the file would keep it all in memory
+def classify_tokens(tokens, found):
+    for token in set(tokens):
+        # address:port or a label such as ip:10.0.0.7, each part is tried on its own
+        if token.count(':') == 1 and '.' in token:
+            classify_tokens(token.split(':'), found)
+            continue
+        if '.' not in token and ':' not in token or token == '::':    # a bare :: is a separator rather than a host
+            continue
+        if '/' in token:
+            try:
+                network = ipaddress.ip_network(token, strict=False)
+            except ValueError:
+                continue
+            if network.num_addresses > int(cfg['import_cidr_limit']):
+                found['skipped'].append(token)
+                continue
+            hosts = network if network.num_addresses <= 2 else network.hosts()
+            found[network.version].update(map(int, hosts))
+            continue
+        for family, version in ((socket.AF_INET, 4), (socket.AF_INET6, 6)):
+            try:
+                found[version].add(int.from_bytes(socket.inet_pton(family, token.split('%')[0]), 'big'))
+                break
+            except OSError:
+                pass
         else:
-            undo_changes['outer'].append({'action': 'r', 'name': prof_name})
+            if fqdn_re.fullmatch(token):
+                found['name'].add(token.lower())
 
-    if action == 'insert':
-        if nested:
-            undo_changes[prof_name] = add({'action': 'i', 'location': location, 'value': value})
-        else:
-            undo_changes['outer'].append({'action': 'i', 'value': value})
+# The addresses of the profile are compared in the same form read_addresses() returns them in
+def canonical_address(address):
+    try:
+        return str(ipaddress.ip_address(address.split('%')[0]))
+    except ValueError:
+        return address.lower()
+
+# Hosts are matched by their address: the missing ones are commented out, the ones that came back are uncommented
+# and new ones are appended, everything else (names, details) is left as it is. Being a single keypress,
+# the whole sync is undone at once
+def sync_profile(num, addresses):
+    head, end = prof_heads[num], prof_end(num)
+    wanted = set(addresses)
+    known = set()
+    removed = restored = 0
+    for index in range(head + 1, end):
+        fields = profiles[index].split('\t')
+        if len(fields) < 3:
+            continue
+        address = canonical_address(fields[2].strip())
+        known.add(address)
+        commented = fields[1].startswith('#')
+        if address not in wanted and not commented:
+            set_line(index, '\t#' + profiles[index][1:])
+            removed += 1
+        elif address in wanted and commented:
+            set_line(index, '\t' + profiles[index][2:])
+            restored += 1
+    new = [address for address in addresses if address not in known]
+    if new:
+        width = max(2, len(str(end - head - 1 + len(new))))
+        insert_lines(end, [f'\thost_{str(ind).zfill(width)}\t{address}\n' for ind, address in enumerate(new, end - head - 1)])
+    return len(new), removed, restored
 
 def start_tmux():
-    global tmux
+    global tmux, tmux_pending
     if shutil.which('tmux'):
-        tmux = subprocess.Popen(['tmux', '-C', 'new-session', '-A', '-s', cfg['session_name']], bufsize=1, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with lock:
+            tmux = subprocess.Popen(['tmux', '-C', 'new-session', '-A', '-s', cfg['session_name']], bufsize=1, text=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            tmux_pending = deque()
+        threading.Thread(target=__tmux_reader, args=[tmux, tmux_pending], daemon=True).start()
         tmux_exec('refresh-client -f no-output')
         return True
     return False
 
 
+# Profiles are moved as whole blocks taken from prof_heads, so the hosts always stay with their own header (even if
+# the header is duplicated) and the ids move along with them. The list is left untouched if it is already sorted,
+# which is the usual case, as only an edited or a newly added profile can be out of place
 def sort_profiles():
     global profiles
-    sorted_prof = [prof for prof in profiles if prof[0] != '\t']
-    sorted_prof.sort(key=str.lower)
-    result = []
-    for prof in sorted_prof:
-        result.append(prof)
-        for conn in profiles[profiles.index(prof) + 1:]:
-            if conn[0] != '\t':
-                break
-            result.append(conn)
+    keys = [profiles[head].lower() for head in prof_heads]
+    if all(prev <= key for prev, key in zip(keys, keys[1:])):
+        return
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    journal('sort')
+    result = profiles[:prof_heads[0]]
+    for num in order:
+        result.extend(profiles[prof_heads[num]:prof_end(num)])
+    ids = [prof_ids[num] for num in order]
     profiles = result
+    index_profiles(ids)
+    bump()
+
+def sort_lines(lines):
+    heads = [i for i, line in enumerate(lines) if line[0] != '\t']
+    if not heads:
+        return lines
+    ends = heads[1:] + [len(lines)]
+    result = lines[:heads[0]]
+    for head, end in sorted(zip(heads, ends), key=lambda block: lines[block[0]].lower()):
+        result.extend(lines[head:end])
+    return result
 
 
 def tailing_print(start_from_the_end=True):
-    global nodetails
+    global nodetails, log_viewer
     if not nodetails:
         nodetails = True
         redraw(breakout=False)
     stop_print.clear()
-    l = open(cfg['logfile'])
-    if start_from_the_end:
-        l.seek(0, 2)
-    else:
-        with open(cfg['logfile'], "rb") as f:
-            linecount = sum(1 for _ in f)
-        while linecount > curses.LINES - scr.getyx()[0]:
-            l.readline()
-            linecount -= 1
-    threading.Thread(target=__continuous_print, args=[l], daemon=True).start()
-
-def __continuous_print(fd):
-
-    def tailf():
-        while not stop_print.is_set():
-            line = fd.readline()
-            if not line or not line.endswith('\n'):
-                sleep(0.01)
-                continue
-            yield line
-        fd.close()
-        return
-
+    l = open(cfg['logfile'], 'rb')
+    l.seek(0, 2)
+    backfill = [] if start_from_the_end else last_lines(l, curses.LINES - scr.getyx()[0])
+    log_viewer = threading.Thread(target=__continuous_print, args=[l, backfill], daemon=True)
+    log_viewer.start()
+
+# Reads blocks backwards from the current position until enough lines are found, leaving the position after the last full line
+def last_lines(fd, count):
+    end = pos = fd.tell()
+    data = b''
+    while pos > 0 and data.count(b'\n') <= count:
+        step = min(8192, pos)
+        pos -= step
+        fd.seek(pos)
+        data = fd.read(step) + data
+    *lines, partial = data.split(b'\n')
+    fd.seek(end - len(partial))
+    return [line.decode(errors='replace') + '\n' for line in lines[-count:]]
+
+# The log writer notifies log_cond after every batch, so the viewer sleeps until there is something new
+# and repaints at most tail_fps times a second no matter how fast the lines come
+def __continuous_print(fd, backfill):
     lucorner = len('\t'.join(profiles[resolve('conn')].split('\t')[:3]).expandtabs().rstrip()) + tabsize
     if not nested:
         lucorner = len(profiles[resolve('conn')].expandtabs().rstrip()) + (tabsize * (4 - len(profiles[resolve('conn')].expandtabs().rstrip()) // tabsize))
+    frame.clear()
     msgwin = curses.newwin(curses.LINES, curses.COLS - 10, scr.getyx()[0], lucorner)
-    message = []
-    for linenum, line in enumerate(tailf()):
-        msgwin.erase()
-        if linenum > curses.LINES - scr.getyx()[0] - 6:
-            message.pop(0)
-        message.append(line)
-        msgwin.addstr(''.join(message))
-        msgwin.refresh()
+    message = deque(backfill, maxlen=max(1, curses.LINES - scr.getyx()[0] - 5))
+    interval = 1 / max(1, int(cfg['tail_fps']))
+    partial = b''
+    dirty = True
+    painted = 0
+    while not stop_print.is_set():
+        chunk = fd.read()
+        if chunk:
+            *lines, partial = (partial + chunk).split(b'\n')
+            message.extend(line.decode(errors='replace') + '\n' for line in lines)
+            dirty = dirty or bool(lines)
+        elif os.path.exists(cfg['logfile']) and os.stat(cfg['logfile']).st_ino != os.fstat(fd.fileno()).st_ino:
+            fd.close()          # the log was rotated, follow the new file from its beginning
+            fd = open(cfg['logfile'], 'rb')
+            continue
+        if dirty and time() - painted >= interval:
+            msgwin.erase()
+            msgwin.addstr(''.join(message))
+            msgwin.refresh()
+            dirty = False
+            painted = time()
+        with log_cond:
+            if not stop_print.is_set():
+                log_cond.wait(timeout=interval if dirty else 1)
+    fd.close()
 
 def main_thread_handler(exc_type, exc_value, exc_traceback):
     deinitialize_scr(noexit=True)
@@ -942,145 +2231,52 @@ def thread_handler(args):
         reason = 'during the creation of the connection'
     if 'starter' in func:
         reason = 'while sending macroses command to the tmux'
-    if 'thr_handler' in func:
-        reason = 'in the forked process managing'
     if '__continuous_print' in func:
         reason = 'during the procedure of continious log streaming'
-    if '__proc_watcher' in func and args.exc_type is AssertionError:
-        return
+    if '__connection_worker' in func:
+        reason = 'while waiting for a free slot to create the connection'
+    if '__journal_writer' in func:
+        reason = 'while writing the journal of changes'
+    if '__log_writer' in func:
+        reason = 'while writing to the log file'
+    if '__tmux_reader' in func:
+        reason = 'while reading the output of tmux control mode client'
+    if '__supervise' in func:
+        reason = 'in the forked process managing'
 
     wrt(traceback.format_exc())
     msgq.append(f'There was an unhandled error {reason}, see log for details')
 
 
 def redo():
-    global highlstr
-    prof_name = profiles[resolve('prof')] if nested else 'outer'
-    redraw_location = None
-
-    if nested and len(redo_changes.get(prof_name, [])) == 0:
-        print_message('No changes were undone for this profile, nothing to redo')
-        return
-    if not nested and len(redo_changes['outer']) == 0:
-        print_message("No changes were undone to the profiles' scope, nothing to undo")
+    scope = prof_ids[prof_num(resolve('prof'))] if nested else 'outer'
+    if not redo_log.get(scope):
+        print_message('No changes were undone for this profile, nothing to redo' if nested else "No changes were undone to the profiles' scope, nothing to redo")
         return
-
-    change = redo_changes[prof_name].pop()
-    undo_changes[prof_name].append(buffer_changes[prof_name].pop())
-    if change.get('location'):
-        change['location'] = [profiles.index(prof_name) + i  for i in change['location']]
-    match change['action']:
-        case 'e':
-            if change.get('location'):
-                for location, value in zip(change['location'], change['value']):
-                    profiles[location] = value
-            else:
-                location = profiles.index(change['name'])
-                profiles[location] = change['value'][0]
-                msgq.append(f'Changed {redo["value"]}back to {change["value"][0]}')
-                redraw_location = len([i for i in profiles[:location] if not i.startswith('\t')])
-        
-        case 'r':
-            if change.get('location'):
-                for location in change['location']:
-                    del profiles[location]
-            else:
-                location = profiles.index(change['name'])
-                for i in profiles[location + 1:]:
-                    if not i.startswith('\t'):
-                        break
-                    del profiles[location + 1]
-                del profiles[location]
-                msgq.append('Deleted ' + 'change["name"].replace("\n", " ").replace("\t", "  ")' + ' profile and all of its contents')
-                highlstr -= 1 if location - resolve('prof') < 0 else 0
-
-        case 'i':
-            if change.get('location'):
-                for location, value in zip(change['location'], change['value']):
-                    profiles[location:location] = [value]
-            else:
-                profiles[0:0] = change['value']
-                msgq.append('Restored and moved to the top previously removed profile')
-                redraw_location = 0
-
-    if not change.get('location'):
-        redraw(redraw_location, breakout=False)
-        return
-    redraw(change.get('location')[0] - profiles.index(prof_name), breakout=False)
-
+    redraw_history(apply_history(redo_log, undo_log, scope))
 
 def undo(signal, frame):
-    global highlstr
-    prof_name = profiles[resolve('prof')] if nested else 'outer'
-    redraw_location = None
-    
-    if nested and len(undo_changes.get(prof_name, [])) == 0:
-        print_message('No changes were made to this profile to undo')
-        return
-
-    if not nested and len(undo_changes['outer']) == 0:
-        print_message("No changes were made to the profiles' scope")
+    close_change()
+    scope = prof_ids[prof_num(resolve('prof'))] if nested else 'outer'
+    if not undo_log.get(scope):
+        print_message('No changes were made to this profile to undo' if nested else "No changes were made to the profiles' scope")
         return
-
-    change = undo_changes[prof_name].pop()
-    redo = deepcopy(change)
-    redo_changes[prof_name] = redo_changes.get(prof_name, []) + [redo]
-    buffer_changes[prof_name] = buffer_changes.get(prof_name, []) + [deepcopy(change)]
-    if change.get('location'):
-        change['location'] = [profiles.index(prof_name) + i  for i in change['location']]
-    match change['action']:
-        case 'e':
-            if change.get('location'):
-                redo['value'].clear()
-                for location, value in zip(change['location'], change['value']):
-                    redo['value'].append(profiles[location])
-                    profiles[location] = value
-            else:
-                location = profiles.index(change['name'])
-                redo['value'] = change['name']
-                profiles[location] = change['value'][0]
-                msgq.append(f'Changed {redo["value"]}back to {change["value"][0]}')
-                #redraw_location = len([i for i in profiles[:location] if not i.startswith('\t')])
-        
-        case 'r':
-            redo['action'] = 'i'
-            redo['value'] = []
-            if change.get('location'):
-                for location in change['location']:
-                    redo['value'].append(profiles[location])
-                    del profiles[location]
-            else:
-                location = profiles.index(change['name'])
-                redo['value'].append(change['name'])
-                for i in profiles[location + 1:]:
-                    if not i.startswith('\t'):
-                        break
-                    redo['value'].append(i)
-                    del profiles[location + 1]
-                del profiles[location]
-                msgq.append('Deleted ' + redo["value"][0].replace("\n", " ").replace("\t", "  ") + 'profile and all of its contents')
-                highlstr -= 1 if location - resolve('prof') < 0 else 0
-
-        case 'i':
-            redo['action'] = 'r'
-            redo['value'].clear()
-            if change.get('location'):
-                for location, value in zip(change['location'], change['value']):
-                    profiles[location:location] = [value]
-            else:
-                profiles[0:0] = change['value']
-                redo['name'] = change['value'][0]
-                msgq.append('Restored and moved to the top previously removed profile')
-                redraw_location = 0
-    
-    if not change.get('location'):
-        redraw(redraw_location, breakout=False)
+    redraw_history(apply_history(undo_log, redo_log, scope))
+
+# ops are the inverse of what was just applied, the cursor is put on the first host they touched
+def redraw_history(ops):
+    if any(op[0] == 'rp' for op in ops):
+        msgq.append('Restored previously removed profile')
+    if nested:
+        offsets = [op[2] for op in ops if op[0] in ('r', 'i', 's')]
+        conns = prof_end(prof_num(resolve('prof'))) - resolve('prof') - 1
+        redraw(max(1, min(min(offsets, default=pos), conns)), breakout=False)
         return
-    redraw(change.get('location')[0] - profiles.index(prof_name), breakout=False)
+    redraw(breakout=False)
 
 def unique_name(name):
     actualname = ''
-    profnames = [i.strip() for i in profiles if not i.startswith('\t')]
+    profnames = {profiles[head].strip() for head in prof_heads}
     while name in profnames:
         actualname = name.split('\t')[0]
         if actualname[-1].isdigit():
@@ -1095,11 +2291,59 @@ def unique_name(name):
     return name
 
 
+# Lines are only queued here, a single writer thread writes them in batches, so neither the UI thread
+# nor the processes' supervisor ever wait for the disk
 def wrt(*values):
-    for value in values:
-        if len(str(value)) > 0:
-            log.write(str(value) + '\n')
-    log.flush()
+    with log_cond:
+        for value in values:
+            if len(str(value)) > 0:
+                log_queue.append(str(value) + '\n')
+        log_cond.notify_all()
+
+def open_log():
+    global log, log_writer
+    log = open(cfg['logfile'], 'a')
+    log_writer = threading.Thread(target=__log_writer, daemon=True)
+    log_writer.start()
+
+def __log_writer():
+    while True:
+        with log_cond:
+            log_cond.wait_for(lambda: log_queue)
+            batch = list(log_queue)
+        log.write(''.join(batch))
+        log.flush()
+        if int(cfg['log_max_size']) and log.tell() >= int(cfg['log_max_size']):
+            rotate_log()
+        with log_cond:
+            for _ in batch:         # lines leave the queue only once written, so flush_log() can wait for an empty one
+                log_queue.popleft()
+            log_cond.notify_all()
+
+# log -> log.1 -> ... -> log.{log_keep}, older segments are compressed with gzip if log_compress is set
+def rotate_log():
+    global log
+    log.close()
+    suffix = '.gz' if int(cfg['log_compress']) else ''
+    keep = int(cfg['log_keep'])
+    for num in range(keep - 1, 0, -1):
+        for ext in ('', '.gz'):
+            if os.path.exists(f"{cfg['logfile']}.{num}{ext}"):
+                os.replace(f"{cfg['logfile']}.{num}{ext}", f"{cfg['logfile']}.{num + 1}{ext}")
+    if keep:
+        if suffix:
+            with open(cfg['logfile'], 'rb') as src, gzip.open(f"{cfg['logfile']}.1.gz", 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(cfg['logfile'])
+        else:
+            os.replace(cfg['logfile'], f"{cfg['logfile']}.1")
+    log = open(cfg['logfile'], 'w')
+
+def flush_log(timeout=2):
+    if log_writer is None:
+        return
+    with log_cond:
+        log_cond.wait_for(lambda: not log_queue, timeout=timeout)
 
 
 class Textbox_enhanced(Textbox):
@@ -1233,7 +2477,7 @@ signal.signal(signal.SIGTERM, normalexit)
 signal.signal(signal.SIGPOLL, neighbors)
 signal.signal(signal.SIGUSR1, neighbors)
 signal.signal(signal.SIGUSR2, macros)
-signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+signal.signal(signal.SIGCHLD, signal.SIG_DFL)
 signal.signal(signal.SIGTSTP, undo)
 threading.excepthook = thread_handler
 sys.excepthook = main_thread_handler
@@ -1248,30 +2492,8 @@ if sys.prefix == sys.base_prefix and os.path.isdir(userdir + '/venv/lib'):
             sys.path.insert(0, f'{userdir}/venv/lib/{i}/site-packages/')
             msgq.append(f'Added {userdir}/venv/lib/{i}/site-packages/ to the path to search for modules')
 
-KEYRING = 0
-try:
-    import keyring
-    ringname = keyring.get_keyring().name
-    if ringname == 'fail Keyring':
-        msgq.append(f'keyring module is installed, but no suitable backend found')
-    else:
-        KEYRING = 1
-    msgq.append(f'Initializied keyring using the following backend - {ringname}')
-except ModuleNotFoundError:
-    msgq.append('keyring module is not installed')
-except keyring.errors.InitError:
-    msgq.append('keyring module is installed, but failed to initialize')
-
-GNUPG = 0
-try:
-    from gnupg import GPG
-    if shutil.which('gpg'):
-        gpg = GPG()
-        GNUPG = 1
-    else:
-        msgq.append('gnupg module is installed, but no gpg executable found')
-except ModuleNotFoundError:
-    msgq.append('gnupg module is not installed niether globally nor in a virtual environment')
+KEYRING = GNUPG = None     # both are initialized only once an encrypted file is read or the profiles are saved
+startup_marks = [('start', perf_counter())] if '--startup-time' in sys.argv else None
 
 cfg = {
     'file_path': f'{userdir}/profiles',
@@ -1302,10 +2524,36 @@ cfg = {
     'src_tunnel_port': '',
     'dst_tunnel_port': '',
     'new_profile': ['New profile\n', '\tnew\t10.100.0.0\n'],
-    'max_conn_displayed': 30
+    'max_conn_displayed': 30,
+    'tmux_timeout': 5,
+    'panes_per_window': 4,
+    'max_connecting': 10,
+    'max_children': 20,
+    'tunnel_probe_timeout': 5,
+    'tunnel_restarts': 5,
+    'tunnel_backoff_max': 60,
+    'max_per_profile': 0,
+    'max_per_jump': 0,
+    'conn_rate': 0,
+    'wf_retries': 2,
+    'control_master': 0,
+    'control_persist': 600,
+    'control_dir': f'/tmp/sshc-{getuser()}',
+    'log_max_size': 10485760,
+    'log_keep': 5,
+    'log_compress': 0,
+    'tail_fps': 20,
+    'templ_timeout': 30,
+    'templ_cache_ttl': 0,
+    'journal': 1,
+    'journal_compact': 200,
+    'undo_limit': 100000,
+    'undo_persist': 0,
+    'import_cidr_limit': 1024
 }
 
 parse_config()
+mark_startup('config')
 
 with open(cfg['pidfile_path'] + '/pid', 'w') as pidfile:
     pidfile.write(str(os.getpid()))
@@ -1314,14 +2562,14 @@ mainfile = cfg['file_path']
 
 profiles = []
 if os.path.isfile(mainfile):
-    filetype = os.popen(f'file --mime-type -b {mainfile}').read()
+    filetype = file_type(mainfile)
 
     if 'pgp-encrypted' in filetype:
         
-        if not GNUPG:
+        if not init_gnupg():
             exit('Profiles file is encrypted but python3-gnupg is not installed')
         
-        if KEYRING:
+        if init_keyring():
             key = keyring.get_password(mainfile, getuser())
             if key:
                 profiles = decrypt(mainfile, key)
@@ -1347,17 +2595,20 @@ if os.path.isfile(mainfile):
             profiles = f.readlines()
 
     elif 'empty' in filetype:
-        profiles = cfg['new_profile']
+        profiles = list(cfg['new_profile'])
 
     else:
-        exit('Profiles file is not in a plain text, nor considered to be pgp-encrypted according to the "file" utility')
+        exit('Profiles file is not in a plain text, nor considered to be pgp-encrypted')
 
 else:
-    profiles = cfg['new_profile']
+    profiles = list(cfg['new_profile'])
     msgq.append('Profiles file was not found (which is normal during the first launch), the new one will be saved after exiting the program')
 
+mark_startup('profiles')
+
 if not start_tmux():
     msgq.append('Unable to start a tmux control process, likely because tmux executable is missing')
+mark_startup('tmux')
 
 scr = curses.initscr()
 scr.keypad(True)
@@ -1369,24 +2620,35 @@ except:
     pass
 
 max_displayed = int(cfg['max_conn_displayed']) if curses.LINES - 3 > int(cfg['max_conn_displayed']) else curses.LINES - 3
-log = open(cfg['logfile'], 'w')
-profs_hash = hash(str(profiles))
+open_log()
+wrt(f'\n[{os.getpid()}] session started')
+recovered = replay_journal()
+index_profiles()
+saved_generation = generation
+open_journal()
+if recovered:
+    compact_journal()
+else:
+    load_history()
 curses.curs_set(0)
 curses.meta(True)
 redraw(0, breakout=False)
+mark_startup('first frame')
 
-if threading.active_count() > 1:
-    print_message('The application is ready to work, but not all of the template substitution has finished executing')
-    while threading.active_count() != 2:    # !!!!!!!fuck this busysleep!!!!!!!
-        continue
-    redraw(breakout=False)
-    print_message('Template substitution finished, good to work')
+if templ_pending:
+    pending = [name for name, commands in cfg['templ_list'].items() if any(f'#{{{cmd}}}' in commands for cmd in templ_pending)]
+    msgq.append(f'Template substitution is still running for: {", ".join(pending)}, connections using them will wait for it')
+
+if startup_marks is not None:
+    wrt(startup_report())
+    msgq.append(startup_report())
 
 if msgq:    # offset for startup information if there is any
     msgq = ['The following errors/warnings were encountered during the startup:\n\n'] + msgq
 
 
 while True:
+    close_change()
     nodetails = False
     tab_completion = False
     file_selection = ''
@@ -1405,11 +2667,14 @@ while True:
         wrt(f'Number of pressed key - {keypress}')
         continue
 
-    if 'print' in str(threading.enumerate()):
+    if log_viewer is not None:
         stop_print.set()
-        [th for th in threading.enumerate() if 'print' in th.name][0].join()
+        with log_cond:
+            log_cond.notify_all()
+        log_viewer.join()
+        log_viewer = None
     if profiles_count == 0 and keypress not in [23, 263]:   # if nothing is displayed, no need to accept anything else except
-        continue                                            # those presses that reduce the sorting string
+        continue                                            # those presses that reduce the sorting string or search
 
     try:
         match keypress:
@@ -1424,7 +2689,7 @@ while True:
                 if highlstr + 1 == profiles_count:
                     redraw(0)
 
-                for index, value in enumerate(profiles[resolve('prof') + conn_count + 2:]):
+                for index, value in enumerate(islice(profiles, resolve('prof') + conn_count + 2, None)):
                     if not value.startswith('\t') or index == max_displayed:
                         break
                     if highlstr + 1 + index + 1 >= curses.LINES - 3:
@@ -1454,7 +2719,7 @@ while True:
                         redraw(curses.LINES - 3 - exceed - 1)
                     redraw(profiles_count - 1)
 
-                for index, value in enumerate(reversed(profiles[:resolve('prof')])):
+                for index, value in enumerate(islice(reversed(profiles), len(profiles) - resolve('prof'), None)):
                     if not value.startswith('\t') or index == max_displayed:
                         break
                     if highlstr + 1 + index > curses.LINES - 3:
@@ -1503,12 +2768,12 @@ while True:
                     num = 9
 
                 if num == 3:
-                    for move, conn in enumerate(profiles[resolve('conn') + 1:], pos + 2):
+                    for move, conn in enumerate(islice(profiles, resolve('conn') + 1, None), pos + 2):
                         if conn.startswith('\t#'):
                             jump = move
                             break
                         if not conn.startswith('\t'):
-                            for move, conn in enumerate(profiles[resolve('prof') + 1:], 2):
+                            for move, conn in enumerate(islice(profiles, resolve('prof') + 1, None), 2):
                                 if not conn.startswith('\t'):
                                     break
                                 if conn.startswith('\t#'):
@@ -1527,6 +2792,20 @@ while True:
 
                 redraw(jump if jump != 0 else pos + num)
 
+            case 338 | 339 | 262 | 360:   # PgDn, PgUp, Home and End jump over a screen of hosts (or profiles) at once
+                page = max_displayed - 2 if nested else curses.LINES - 4
+                if nested:
+                    if keypress in (338, 339):
+                        redraw(max(1, min(conn_count, pos + (page if keypress == 338 else -page))))
+                    redraw(1 if keypress == 262 else conn_count)
+
+                highlstr = 0
+                if keypress in (338, 339):
+                    topprof = max(0, min(len(shown_profs) - 1, topprof + (page if keypress == 338 else -page)))
+                else:
+                    topprof = 0 if keypress == 262 else len(shown_profs) - 1
+                redraw(0)
+
             case 336 | 337:   # Shift + arrow down/up for mass host selection
                 if nested:
                     filtered = []
@@ -1547,10 +2826,12 @@ while True:
                 for conn in sorted(picked_cons, reverse=True):
                     conn_index = start + conn
                     if conn == conn_count:
-                        profiles[start+1:start+1] = [profiles[conn_index]]
-                        profiles.pop(conn_index + 1)
+                        insert_lines(start + 1, [profiles[conn_index]])
+                        remove_lines(conn_index + 1)
                         break
-                    profiles[conn_index], profiles[conn_index + 1] = profiles[conn_index + 1], profiles[conn_index]
+                    upper, lower = profiles[conn_index], profiles[conn_index + 1]
+                    set_line(conn_index, lower)
+                    set_line(conn_index + 1, upper)
                 picked_cons = set(map(lambda x: x + 1, picked_cons))
                 if max(picked_cons) > conn_count:
                     picked_cons.remove(conn_count + 1); picked_cons.add(1)
@@ -1569,10 +2850,12 @@ while True:
                 for conn in sorted(picked_cons):
                     conn_index = start + conn
                     if conn == 1:
-                        profiles[end+1:end+1] = [profiles[conn_index]]
-                        profiles.pop(conn_index)
+                        insert_lines(end + 1, [profiles[conn_index]])
+                        remove_lines(conn_index)
                         break
-                    profiles[conn_index], profiles[conn_index - 1] = profiles[conn_index - 1], profiles[conn_index]
+                    upper, lower = profiles[conn_index - 1], profiles[conn_index]
+                    set_line(conn_index - 1, lower)
+                    set_line(conn_index, upper)
                 picked_cons = set(map(lambda x: x - 1, picked_cons))
                 if min(picked_cons) == 0:
                     picked_cons.remove(0); picked_cons.add(conn_count)
@@ -1604,9 +2887,8 @@ while True:
                     redraw()
 
             case 16:        # Ctrl+P - Create a continuously updating window with the log file contents in it
-                with open(cfg['logfile'], "rb") as f:
-                    linecount = sum(1 for _ in f)
-                if linecount == 0:
+                flush_log()
+                if os.path.getsize(cfg['logfile']) == 0:
                     print_message('The log is empty')
                 else:
                     tailing_print(start_from_the_end=False)
@@ -1618,7 +2900,6 @@ while True:
                 replace_line = resolve('prof')
                 if nested:
                     replace_line = resolve('conn')
-                old_value = profiles[replace_line]
                 editline = profiles[replace_line].rstrip()
 
                 lasttab = 0
@@ -1639,13 +2920,11 @@ while True:
                 if not nested and newline != profiles[replace_line].strip():
                     newline = unique_name(newline)
 
-                profiles[replace_line] = newline + '\n'
-                if old_value != newline + '\n':
-                    save_changes('edit', pos, old_value)
+                set_line(replace_line, newline + '\n')
                 if not nested and len(sort) > 0 and not pattern.match(newline.split('\t')[0]):
                     sort = ''
                     for char in newline:
-                        sorted_profs = sorted([i for i in profiles if i[0] != '\t' and pattern.match(i)], key=str.lower)
+                        sorted_profs = sorted([profiles[head] for head in prof_heads if pattern.match(profiles[head])], key=str.lower)
                         if sorted_profs and newline.split('\t')[0] == sorted_profs[0].split('\t')[0].strip():
                             break
                         sort += char.lower()
@@ -1655,8 +2934,7 @@ while True:
 
             case 14:    # Ctrl+N for adding new profiles and servers
                 if nested:
-                    profiles[resolve('conn') + 1:resolve('conn') + 1] = ['\tnew\t10.100.0.0\n']
-                    save_changes('remove', pos + 1)
+                    insert_lines(resolve('conn') + 1, ['\tnew\t10.100.0.0\n'])
                     if highlstr + (pos - topconn) == curses.LINES - 4:
                         topprof += 1
                         highlstr -= 1
@@ -1670,8 +2948,7 @@ while True:
                 if cfg['default_templ'] and '\t' not in cfg['new_profile']:
                     profname += '\t' + cfg["default_templ"]
                 new_name = unique_name(profname) + '\n'
-                profiles = [new_name, *hosts] + profiles
-                save_changes('remove', new_name)
+                insert_lines(0, [new_name, *hosts])
                 reset(n=False)
 
             case 18:     # Ctrl+R for removing profiles or servers
@@ -1679,7 +2956,6 @@ while True:
                 if nested:
                     if len(picked_cons) == 0: picked_cons.add(pos)
                     picked_resolved = sorted(map(lambda x: x + prof_head, picked_cons), reverse=True)
-                    save_changes('insert', sorted(picked_cons), [profiles[i] for i in picked_resolved])
 
                     for conn in picked_resolved:
                         if topconn and conn in range(conn_count - max_displayed, conn_count + 1):
@@ -1688,7 +2964,7 @@ while True:
                             msgq.append('Removing the only one left host is not safe. Consider editing it or removing profile')
                             picked_cons = set()
                             redraw(sort_profs=True)
-                        profiles.pop(conn)
+                        remove_lines(conn)
 
                     redrawpoint = min(picked_cons)
                     if redrawpoint > conn_count - len(picked_cons):
@@ -1697,13 +2973,8 @@ while True:
                     picked_cons = set()
                     redraw(redrawpoint)
 
-                for index, value in enumerate(profiles[prof_head + 1:], 1):
-                    if value[0] != '\t':
-                        prof_end = prof_head + index
-                        break
-                    prof_end = prof_head + index + 1   # this copied only for the case of the last profile removal
-                save_changes('insert', value=profiles[prof_head:prof_end])
-                del profiles[prof_head:prof_end]
+                head_end = prof_end(prof_num(prof_head))
+                remove_lines(prof_head, head_end - prof_head)
                 if highlstr == 0:
                     redraw(sort_profs=True)
                 redraw(highlstr - 1, sort_profs=True)
@@ -1725,8 +2996,7 @@ while True:
                             copy = copy.replace(origip, incrip)
                     except Exception:
                         wrt(traceback.format_exc())
-                profiles[copy_point+1:copy_point] = [copy]
-                save_changes('remove', pos + 1)
+                insert_lines(copy_point + 1, [copy])
 
                 if highlstr + (pos - topconn) == curses.LINES - 4:
                     topprof += 1
@@ -1750,26 +3020,23 @@ while True:
             case 402:   # Shift + arrow right for applying copied details (can be used on many)
                 if nested:
                     if len(picked_cons) == 0: picked_cons.add(pos)
-                    picked_resolved = sorted(map(lambda x: x + resolve('prof'), picked_cons))
-                    save_changes('edit', picked_cons, [profiles[i] for i in picked_resolved])
 
                     for conn in picked_cons:
                         line = profiles[resolve('prof') + conn].split('\t')
                         if copied_details == '':
-                            profiles[resolve('prof') + conn] = '\t'.join(line[:3]).strip('\n') + '\n'
+                            set_line(resolve('prof') + conn, '\t'.join(line[:3]).strip('\n') + '\n')
                         else:
-                            profiles[resolve('prof') + conn] = '\t'.join(line[:3]).strip('\n') + '\t' + copied_details.strip('\n') + '\n'
+                            set_line(resolve('prof') + conn, '\t'.join(line[:3]).strip('\n') + '\t' + copied_details.strip('\n') + '\n')
 
                     picked_cons = set()
                     redraw()
 
-                old_value = profiles[resolve('prof')]
-                line = profiles[resolve('prof')].split('\t')
+                prof_head = resolve('prof')
+                line = profiles[prof_head].split('\t')
                 if copied_details == '':
-                    profiles[resolve('prof')] = '\t'.join(line[:1]).strip('\n') + '\n'
+                    set_line(prof_head, '\t'.join(line[:1]).strip('\n') + '\n')
                 else:
-                    profiles[resolve('prof')] = '\t'.join(line[:1]).strip('\n') + '\t' + copied_details.strip('\n') + '\n'
-                save_changes('edit', value=old_value)
+                    set_line(prof_head, '\t'.join(line[:1]).strip('\n') + '\t' + copied_details.strip('\n') + '\n')
                 redraw()
 
             case 27:    # Alt+Z reverse reversed changes
@@ -1787,41 +3054,47 @@ while True:
                 prof_index = resolve("prof")
                 winname = profiles[prof_index].split("\t")[0].strip()
                 repeats = {}
-                for counter, conn in enumerate(picked_cons):
-                    if counter == 0:
-                        pane = int(tmux_exec(f'new-window -n "{winname}" -P -F " #{{pane_id}}"', output=1).strip()[1:]) - 1
-                    elif counter % 4 == 0 and counter > 0:      # 4 is the optimal amount of panes per tiled window
-                        tmux_exec(f'select-layout tiled\nnew-window -n "{winname}"')
-                    else:
-                        tmux_exec('split-window')
-                    pane += 1
-
+                panenames = []
+                for conn in picked_cons:
                     panename = profiles[prof_index + conn].split("\t")[1]
                     if panename in repeats:
                         repeats[panename] += 1
                         panename += ' #' + str(repeats.get(panename))
                     else:
                         repeats[panename] = 0
-                    tmux_exec(f'select-pane -t %{pane} -T "{panename}"')
-                    threading.Thread(target=create_connection, args=[f'%{pane}',conn]).start()
-                tmux_exec('select-layout tiled')
+                    panenames.append(panename)
+
+                for conn, panename, pane in zip(picked_cons, panenames, plan_panes(winname, panenames)):
+                    if not pane:
+                        msgq.append(f'tmux has not created a pane for {panename}, see log for details')
+                        continue
+                    schedule_connection(pane, conn, prof_index)
                 picked_cons = set()
                 redraw()
 
 
-            case 21:        # Ctrl+U - Upload(?) a profile from file (only IPs)
-                filename = autocomplete_loop('File to take IPs from - ', cfg['import_path'])
+            case 21:        # Ctrl+U - Upload(?) a profile from file (only IPs), inside of a profile it is synced with the file instead
+                filename = autocomplete_loop('File to take IPs from - ' if not nested else 'File to sync the profile with - ', cfg['import_path'])
+                shown = [0]
+                def progress(done):
+                    if done - shown[0] >= 0.02:
+                        shown[0] = done
+                        print_message(f'Reading {filename} - {int(done * 100)}%')
                 try:
-                    file = open(filename)
-                    ips = sorted(set(re.findall(r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', file.read())))
+                    ips, skipped = read_addresses(filename, progress)
                 except Exception:
                     print_message('Could not open or read given file')
-                    file.close()
                     continue
+                if skipped:
+                    msgq.append(f'The following networks have more than {cfg["import_cidr_limit"]} addresses and were skipped: {", ".join(skipped[:20])}')
 
                 if len(ips) == 0:
-                    print_message('Could not find any IP addresses in the file')
-                    file.close()
+                    print_message('Could not find any IP addresses or host names in the file')
+                    continue
+                if nested:
+                    added, removed, restored = sync_profile(prof_num(resolve('prof')), ips)
+                    msgq.append(f'Synced with {filename}: {added} hosts added, {removed} commented out as missing, {restored} returned back')
+                    redraw()
                     continue
 
                 profname = filename[filename.rfind('/') + 1:]
@@ -1830,12 +3103,12 @@ while True:
 
                 if len(cfg['default_templ']) > 0:
                     profname += f'\t{cfg["default_templ"]}'
+                width = max(2, len(str(len(ips) - 1)))
                 newprof = [unique_name(profname) + '\n']
                 for ind, ip in enumerate(ips):
-                    newprof.append(f'\thost_{str(ind).zfill(2)}\t{ip}\n')
+                    newprof.append(f'\thost_{str(ind).zfill(width)}\t{ip}\n')
 
-                profiles = newprof + profiles
-                file.close()
+                insert_lines(0, newprof)
                 reset()
 
             case 12:        # Ctrl+L - Create a background process for tunneling
@@ -1850,7 +3123,7 @@ while True:
                     if len(tunnels) > 1:
                         tun_options = ''
                         for enum, value in enumerate(tunnels.values(), 1):
-                            tun_options += str(enum) + ') [' + value[0] + ']' + ' -> ' + value[2] + '\n'
+                            tun_options += str(enum) + ') ' + tunnel_status(value) + '\n'
                         print_message(f'The list of tunnels the program keeps track of:\n{tun_options}')
                         if len(tunnels) < 10:
                             print_message('Enter a number of a tunnel to interact with', voffset=tun_options.count('\n') + 2)
@@ -1868,10 +3141,10 @@ while True:
                             continue
                         tun_choice = tunnels[list(tunnels.keys())[choice - 1]]
                         redraw(breakout=False)
-                        print_message(f"Chosen tunnel - {'[' + tun_choice[0] + ']' + ' -> ' + tun_choice[2]}")
+                        print_message(f"Chosen tunnel - {tunnel_status(tun_choice)}")
                     else:
                         tun_choice = list(tunnels.values())[0]
-                        print_message(f'The only installed tunnel is - {"[" + tun_choice[0] + "]" + " -> " + tun_choice[2]}')
+                        print_message(f'The only installed tunnel is - {tunnel_status(tun_choice)}')
                     
                     print_message('Action to take (kill or restart) [k/r]', voffset=1)
                     focused = True
@@ -1882,10 +3155,10 @@ while True:
 
                     if action.lower() == 'k':
                         tailing_print()
-                        tun_choice[2] = 'to be killed'
+                        stop_tunnel(tun_choice, 'to be killed')
                     elif action.lower() == 'r':
                         tailing_print()
-                        tun_choice[2] = 'to be restarted'
+                        stop_tunnel(tun_choice, 'to be restarted')
                     else:
                         redraw(breakout=False)
                         print_message('Entered action is neither r nor k')
@@ -1956,24 +3229,29 @@ while True:
 
                 if hp['key'] is not None:
                     ssh_options += f' -i {hp["key"]}'
-                tunnels[0 if not tunnels else max(tunnels.keys()) + 1] = [f'{sport}:{__target if __target else hp["address"]}:{dport}', (ssh_options.split(' '), hp['pass']), 'starting']
+                tunid = next(tunnel_id)
+                tunnels[tunid] = [f'{sport}:{__target if __target else hp["address"]}:{dport}', (ssh_options.split(' '), hp['pass']), 'starting', None,
+                                  {'latency': None, 'up_since': None, 'restarts': 0, 'retry_at': None, 'master': hp['control']}]
                 tailing_print()
-                wrt(f'\nStarting a tunnel with the following command:\nssh {ssh_options}')
-                proc_handler('ssh', ssh_options.split(' '), hp['pass'])
+                open_tunnel(tunid)
 
             case 11:        # Ctrl+K - Put an identity file in remote host's authorized_keys (should work only if password is defined for connection)
                 pass
 
 
-            case 6 | 20:    # Ctrl+F or Ctrl+T for uploading files from or to host
+            case 6 | 20:    # Ctrl+F or Ctrl+T for uploading files from or to the highlighted or picked hosts
                 if not nested:
-                    print_message('File uploading is yet not supported for the multiple hosts at a time')
+                    print_message('Open a profile to transfer files from or to its hosts')
                     continue
+                if len(picked_cons) == 0:
+                    picked_cons.add(pos)
+                prof_index = resolve('prof')
                 try:
-                    hp = conn_params()  # hp - host parameters
+                    hosts = [(profiles[prof_index + conn].split('\t')[1], conn_params(conn)) for conn in sorted(picked_cons)]
                 except Exception:
                     print_message(f'There is an error with the connection parsing\n\n{traceback.format_exc()}')
                     continue
+                picked_cons = set()
 
                 nodetails = True
                 focused = True
@@ -2008,22 +3286,43 @@ while True:
                 else:
                     filename = accept_input(message='Enter a filename to be uploaded from host - ', preinput=cfg['upload_from_path'])
 
+                # several hosts would overwrite each other's file, so every one of them downloads into a directory of its own
+                dests = [cfg['upload_from_dest']] * len(hosts)
+                if action == 'from' and option == 1 and len(hosts) > 1:
+                    names = Counter(name for name, _ in hosts)
+                    dests = [f'{cfg["upload_from_dest"].rstrip("/")}/' + (name if names[name] == 1 else f'{name}_{hp["address"]}').replace('/', '_') for name, hp in hosts]
+                    try:
+                        for dest in dests:
+                            os.makedirs(dest, exist_ok=True)
+                    except OSError as err:
+                        print_message(f'Could not create the directory for the downloaded files - {err}')
+                        continue
+
                 tailing_print()
-                if option == 1:
-                    src, dst = filename, f'{hp["user"]}@{hp["address"]}:'
+                # the hosts are transferred in parallel, as many at a time as max_children allows, the rest wait in the child queue
+                trid = next(transfer_id)
+                transfers[trid] = [f'{"Download" if action == "from" else "Upload"} of {filename}', len(hosts), 0, []]
+                for (name, hp), dest in zip(hosts, dests):
+                    host = f'{name} ({hp["address"]})'
+                    if option != 1:
+                        proc_handler(scripts_dir + custom_opts[option - 2], [hp['address'], str(hp['port']), str(hp['key']), f'"{hp["pass"]}"', str(hp["user"]), str(filename)],
+                                     transfer=(trid, host))
+                        continue
+
+                    remote = f'{hp["user"]}@{hp["address"] if ":" not in hp["address"] else "[" + hp["address"] + "]"}:'
+                    src, dst = filename, remote
                     if action == 'from':
-                        src, dst = f'{hp["user"]}@{hp["address"]}:{filename}', cfg['upload_from_dest']
+                        src, dst = remote + filename, dest
 
-                    scp_options = f'-P {hp["port"]}'
+                    scp_options = ['-P', str(hp['port'])]
                     if hp['key'] is not None:
-                        scp_options += f' -i {hp["key"]}'
+                        scp_options += ['-i', hp['key']]
+                    if master_alive(hp['control']):
+                        scp_options += ['-o', f'ControlPath={hp["control"]}']
 
-                    wrt(f'The following command will be executed:\nscp {scp_options} {src} {dst}')
-                    proc_handler('scp', [scp_options, src, dst], hp['pass'])
+                    wrt(f'The following command will be executed:\nscp {" ".join(scp_options)} {src} {dst}')
+                    proc_handler('scp', scp_options + [src, dst], hp['pass'], transfer=(trid, host))
 
-                else:
-                    subprocess.Popen([scripts_dir + custom_opts[option - 2], hp['address'],
-                                  str(hp['port']), str(hp['key']), f'"{hp["pass"]}"', str(hp["user"]), str(filename)], stdout=log, stderr=log)
                 if action == 'from':
                     upload_from_history.append(filename)
                     continue
@@ -2033,11 +3332,22 @@ while True:
         # [Sorting string manipulation]
 
             case 23:        # Ctrl+W - nuke sort string
-                sort = ''
+                sort = search = ''
                 reset()
 
             case 263:   # backspace removes characters from sorting string
-                sort = sort[:-1]
+                if search:
+                    search = ''
+                else:
+                    sort = sort[:-1]
+                reset()
+
+            case 47:        # / - search through all of the records instead of sorting by profile names
+                query = accept_input(message='Search for - ')
+                if not search_ready:
+                    print_message('Building the search index for the first time')
+                search = query.strip().lower()
+                sort = ''
                 reset()
 
             case _: # rest of the keys for sorting (or ignoring)
@@ -2046,6 +3356,7 @@ while True:
                     redo()
                     continue
                 if keypress in list(range(97, 123)) + list(range(65, 91)) + list(range(48, 58)):
+                    search = ''
                     if nested:
                         sort = chr(keypress)
                     else: